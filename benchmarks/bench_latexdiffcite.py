@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+
+'''Benchmarks of the stages of latexdiffcite on synthetic documents and bibliographies.
+
+Times get_all_ref_keys(), make_author_year_tokens_from_bib(), get_capture_groups_from_bbl(), replace_refs_in_tex()
+and format_refs() separately, for documents and bibliographies scaled by each of the given factors. The growth
+exponent between consecutive scales is printed (1 is linear, 2 is quadratic), and the results are appended to
+results.jsonl together with the latexdiffcite version and git commit, to track them over versions.
+
+Run from the root of the repository, e.g.::
+
+    python benchmarks/bench_latexdiffcite.py --scales 1 2 4 8
+'''
+
+
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import datetime
+import subprocess
+
+from latexdiffcite import latexdiffcite
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+FUNCTIONS = ['get_all_ref_keys', 'make_author_year_tokens_from_bib', 'get_capture_groups_from_bbl',
+             'replace_refs_in_tex', 'format_refs']
+
+
+# ==============================================================================
+#  Synthetic documents and bibliographies
+# ==============================================================================
+
+
+def make_key(i):
+    '''Returns the reference key of entry i'''
+    return 'author{:06d}key'.format(i)
+
+
+def make_surnames(i):
+    '''Returns the surnames of the authors of entry i (1 to 4 authors)'''
+    return ['Surname{}x{}'.format(i, j) for j in range(1 + i % 4)]
+
+
+def make_bib(n_entries):
+    '''Returns contents of a bib file with n_entries entries'''
+    entries = []
+    for i in range(n_entries):
+        entries.append('@article{{{},\n'
+                       '  author = {{{}}},\n'
+                       '  title = {{A synthetic title for entry number {}}},\n'
+                       '  journal = {{Journal of Benchmarks}},\n'
+                       '  year = {{{}}}\n'
+                       '}}\n'.format(make_key(i), ' and '.join(s + ', A.' for s in make_surnames(i)), i,
+                                     1950 + i % 70))
+    return '\n'.join(entries)
+
+
+def make_bbl(n_entries):
+    '''Returns contents of a natbib author-year bbl file with n_entries entries, matching the default bbl regex'''
+    items = ['\\begin{thebibliography}{}\n']
+    for i in range(n_entries):
+        surnames = make_surnames(i)
+        author = surnames[0] + ' et~al.' if len(surnames) > 2 else ' and '.join(surnames)
+        year = 1950 + i % 70
+        items.append('\\bibitem[{{{}({})}}]{{{}}}\n{}, A.\\ ({}), A synthetic title for entry number {},\n'
+                     '\\emph{{Journal of Benchmarks}}.\n'.format(author, year, make_key(i), ', '.join(surnames), year, i))
+    items.append('\\end{thebibliography}\n')
+    return '\n'.join(items)
+
+
+def make_tex(n_citations, n_keys, keys_per_citation):
+    '''Returns contents of a tex file with n_citations citation commands, citing keys_per_citation of the first
+    n_keys bib entries each (so each key is cited about n_citations*keys_per_citation/n_keys times)'''
+    commands = ['citep', 'citet', 'cite']
+    lines = ['\\documentclass{article}', '\\usepackage{natbib}', '\\begin{document}', '']
+    for i in range(n_citations):
+        keys = [make_key((i*keys_per_citation + j) % n_keys) for j in range(keys_per_citation)]
+        lines.append('Sentence number {} of the synthetic document makes a claim \\{}{{{}}}.'.format(
+            i, commands[i % len(commands)], ','.join(keys)))
+        if i % 10 == 9:
+            lines.append('')
+    lines.extend(['', '\\bibliographystyle{plainnat}', '\\bibliography{refs}', '', '\\end{document}', ''])
+    return '\n'.join(lines)
+
+
+# ==============================================================================
+#  Benchmarks
+# ==============================================================================
+
+
+def make_revision(tex, bib, bbl):
+    '''Returns a revision with the given contents and the default config'''
+    rev = latexdiffcite.Revision('bench', 'bench.tex')
+    rev.tex = tex
+    rev.bib = [bib]
+    rev.bib_paths = ['refs.bib']
+    rev.bbl = bbl
+    return rev
+
+
+def prepare(rev, stage):
+    '''Runs the stages of process_revision() that come before stage'''
+    if stage == 'get_all_ref_keys':
+        return
+    latexdiffcite.get_all_ref_keys(rev)
+    if stage in ['make_author_year_tokens_from_bib', 'get_capture_groups_from_bbl']:
+        return
+    latexdiffcite.get_capture_groups_from_bbl(rev)
+    latexdiffcite.make_author_year_tokens_from_bib(rev)
+
+
+def run_stage(rev, stage):
+    '''Runs a single stage on a prepared revision'''
+    if stage == 'format_refs':
+        # the formatting of each citation command, without the replacement in the document
+        for citation in rev.citations:
+            latexdiffcite.format_refs(rev, list(citation.keys), citation.command, citation.prenote,
+                                      citation.postnote)
+    else:
+        getattr(latexdiffcite, stage)(rev)
+
+
+def time_stage(tex, bib, bbl, stage, repeat):
+    '''Returns the best time in seconds of repeat runs of a stage, each on a freshly prepared revision'''
+    best = float('inf')
+    for _ in range(repeat):
+        rev = make_revision(tex, bib, bbl)
+        prepare(rev, stage)
+        start = time.perf_counter()
+        run_stage(rev, stage)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmarks(args):
+    '''Times each stage for each scale, and returns dict of stage -> list of seconds (one for each scale)'''
+    results = dict((stage, []) for stage in args.functions)
+    for scale in args.scales:
+        n_citations = int(args.citations*scale)
+        n_keys = max(1, int(args.keys*scale))
+        n_bib = max(n_keys, int(args.bib_entries*scale))
+        n_bbl = max(n_keys, int(args.bbl_entries*scale))
+        tex = make_tex(n_citations, n_keys, args.keys_per_citation)
+        bib = make_bib(n_bib)
+        bbl = make_bbl(n_bbl)
+        print('scale {:g}: {} citations of {} keys, {} bib entries, {} bbl entries ({:.0f} kB tex, {:.0f} kB bib, '
+              '{:.0f} kB bbl)'.format(scale, n_citations, n_keys, n_bib, n_bbl, len(tex)/1e3, len(bib)/1e3,
+                                      len(bbl)/1e3))
+        for stage in args.functions:
+            # bbl capture groups are only computed with a bbl file, so use it only for that stage
+            results[stage].append(time_stage(tex, bib, bbl if stage == 'get_capture_groups_from_bbl' else '',
+                                             stage, args.repeat))
+    return results
+
+
+def print_results(scales, results, previous=None):
+    '''Prints a table of the results, the growth exponent between consecutive scales, and the ratio to the previous
+    results with the same parameters (if any)'''
+    print()
+    print('{:34s}'.format('seconds') + ''.join('{:>12s}'.format('x{:g}'.format(s)) for s in scales) +
+          '{:>10s}'.format('exponent') + ('{:>14s}'.format('vs. previous') if previous else ''))
+    for stage, times in results.items():
+        exponents = [math.log(t2/t1)/math.log(s2/s1) for s1, s2, t1, t2 in zip(scales, scales[1:], times, times[1:])
+                     if t1 > 0 and t2 > 0]
+        line = '{:34s}'.format(stage) + ''.join('{:12.6f}'.format(t) for t in times)
+        line += '{:10.2f}'.format(exponents[-1]) if exponents else '{:>10s}'.format('-')
+        if previous and stage in previous['results']:
+            line += '{:13.2f}x'.format(times[-1]/previous['results'][stage][-1])
+        print(line)
+    if previous:
+        print('\nprevious: version {}, commit {}, {}'.format(previous['version'], previous['commit'],
+                                                             previous['date']))
+
+
+def git_commit():
+    '''Returns the current git commit of the repository, or None'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(params):
+    '''Returns the last saved results with the same parameters, or None'''
+    if not os.path.isfile(RESULTS_PATH):
+        return None
+    previous = None
+    with open(RESULTS_PATH) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['params'] == params:
+                previous = record
+    return previous
+
+
+def create_parser():
+    '''Creates parser'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 2, 4],
+                        help='factors to scale the number of citations, keys and entries by, default %(default)s')
+    parser.add_argument('--citations', type=int, default=1000, help='citation commands at scale 1, default %(default)s')
+    parser.add_argument('--keys', type=int, default=300, help='cited keys at scale 1, default %(default)s')
+    parser.add_argument('--keys-per-citation', type=int, default=2,
+                        help='keys in each citation command, default %(default)s')
+    parser.add_argument('--bib-entries', type=int, default=1000, help='bib entries at scale 1, default %(default)s')
+    parser.add_argument('--bbl-entries', type=int, default=300, help='bbl entries at scale 1, default %(default)s')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark (best is used), default %(default)s')
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=FUNCTIONS, help='functions to benchmark')
+    parser.add_argument('--no-save', dest='save', action='store_false', help='do not append results to results.jsonl')
+    return parser
+
+
+def main(args=None):
+    '''Runs the benchmarks, prints the results and appends them to results.jsonl'''
+    args = create_parser().parse_args(args)
+    params = dict((k, v) for k, v in vars(args).items() if k != 'save')
+    previous = load_previous(params)
+    results = run_benchmarks(args)
+    print_results(args.scales, results, previous)
+    if args.save:
+        record = {'version': latexdiffcite.__version__, 'commit': git_commit(),
+                  'date': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': sys.version.split()[0], 'params': params, 'results': results}
+        with open(RESULTS_PATH, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        print('\nresults appended to {}'.format(RESULTS_PATH))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,51 +8,78 @@ from __future__ import division, print_function, absolute_import, unicode_litera
 
 import io
 import os
+import sys
 import re
 import json
+import mmap
+import time
+import shutil
+import signal
+import hashlib
+import contextlib
+import sqlite3
 import logging
+import difflib
+import functools
 import argparse
 import tempfile
+import itertools
+import threading
+import traceback
 import subprocess
+import collections
+import concurrent.futures
 
 __version__ = '1.0.6'
 
 log = logging.getLogger(__name__)
 
-# set lgo level and log to stdout
-log.setLevel(logging.INFO)
-log.addHandler(logging.StreamHandler())
-
+# handlers are only added when run from the command line (see setup_logging())
+log.addHandler(logging.NullHandler())
 
 
 # ==============================================================================
-#  Classes to hold "global" variables during runtime
+#  Classes to hold settings and state during runtime
 # ==============================================================================
 
 
 class Config(object):
+    '''Settings for a job: the defaults, optionally overridden by config files'''
 
-    @staticmethod
-    def load_defaults():
+    def __init__(self, *json_files):
+        self.load_defaults()
+        for json_file in json_files:
+            self.load_config(json_file)
+
+    def load_defaults(self):
         '''Loads default config settings'''
         log.debug('loading default settings')
-        Config.encoding = 'utf-8'
-        Config.latexdiff_args = ''
-        Config.git_force_unix_pathsep = True
-        Config.ref_single_word = True
-        Config.bib = {
+        self.encoding = 'utf-8'
+        self.latexdiff_args = ''
+        self.git_force_unix_pathsep = True
+        self.ref_single_word = True
+        self.cache_dir = ''
+        self.cache_max_entries = 100000
+        self.diff_cache_max_mb = 100
+        self.diff_cache_max_days = 30
+        self.no_change_marker = ''
+        self.temp_dir = ''
+        self.latexdiff_transport = 'file'
+        self.flatten = False
+        self.bib_reader = 'read'
+        self.bib = {
             'max_authors': 2,
             'sep_authors_first': ', ',
             'author_serialcomma': True,
             'sep_authors_last': ' and ',
             'et_al': ' et~al.'
         }
-        Config.bbl = {
+        self.bbl = {
             'regex': r'\\bibitem\[{((?:(?!^$).)*?)\(((?:(?!^$).)*?)(?:{\\natexlab{(.?)}})?\)((?:(?!^$).)*?)}\]{%REFKEY%}',
             'author': '%CG1%',
             'year': '%CG2%%CG3%'
         }
-        Config.cmd_format = {
+        self.cmd_format = {
             'citep':
                 {'cite_start': '[',
                  'sep_prenote': ' ',
@@ -95,73 +122,619 @@ class Config(object):
                  'cite_end': ']'}
         }
 
-    @staticmethod
-    def load_config(json_file):
+    def load_config(self, json_file):
         '''Loads settings from config file'''
-        with io.open(json_file, 'r', encoding=Config.encoding) as f:
+        with io.open(json_file, 'r', encoding=self.encoding) as f:
             config = json.load(f)
         for k, v in config.items():
             log.debug('setting Config.%s to %s', k, v)
-            setattr(Config, k, v)
+            setattr(self, k, v)
 
 
-class References(object):
-    '''Container for reference list and corresponding regex capture groups and author/year strings'''
+# a single citation command found in a tex file: span in the string, command name, notes and reference keys
+Citation = collections.namedtuple('Citation', ['start', 'end', 'command', 'prenote', 'postnote', 'keys'])
 
-    refkeys_old = []
-    refkeys_new = []
-    capture_groups_old = {}
-    capture_groups_new = {}
-    authyear_old = {}
-    authyear_new = {}
 
+class Stats(object):
+    '''Timings (in seconds) of the stages of a job or revision, and counters (citations, bytes written, etc.).
+    Can be updated from several threads, and sent to and from a worker process.'''
 
-class Files(object):
-    '''Container for file paths and handles'''
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.lock = threading.Lock()
 
-    out_path = None
-    tex_old_path = None
-    tex_new_path = None
-    bbl_old_path = None
-    bbl_new_path = None
-    bib_old_path = []
-    bib_new_path = []
+    def __getstate__(self):
+        return {'timings': self.timings, 'counters': self.counters}
 
-    # temp files
-    tex_old_tmp_path = None
-    tex_old_tmp_hndl = None
-    tex_new_tmp_path = None
-    tex_new_tmp_hndl = None
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
-    @staticmethod
-    def create_tempfiles():
+    @contextlib.contextmanager
+    def timer(self, stage):
+        '''Context manager adding the time spent in the block to stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings[stage] = self.timings.get(stage, 0) + elapsed
+
+    def count(self, name, n=1):
+        '''Adds n to a counter'''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        '''Returns timings (rounded to microseconds) and counters as dict'''
+        return {'timings': dict((k, round(v, 6)) for k, v in self.timings.items()), 'counters': dict(self.counters)}
+
+
+class DiffJob(object):
+    '''Container for everything needed to diff two revisions: settings, the old and new revisions, the output path
+    and temp files. Jobs share no state, so any number of jobs can be run in the same process, also concurrently.'''
+
+    def __init__(self, tex_old_path, tex_new_path, out_path='diff.tex', config=None, bbl_old_path=None,
+                 bbl_new_path=None, git_revs=None, parallel=False, chunked=False, max_workers=None):
+        self.config = config or Config()
+        self.out_path = out_path
+        self.parallel = parallel
+
+        # run latexdiff on each top-level section, using up to max_workers latexdiff processes at once
+        self.chunked = chunked
+        self.max_workers = max_workers
+        git_revs = git_revs or [None, None]
+        self.old = Revision('old', tex_old_path, bbl_old_path, git_revs[0], self.config)
+        self.new = Revision('new', tex_new_path, bbl_new_path, git_revs[1], self.config)
+
+        # cache of parsed bib files, open while the job runs (or shared between jobs if set before running)
+        self.bib_cache = None
+
+        # parsed bib files by content hash, may be shared between jobs
+        self.bib_files = {}
+
+        # author/year of the references resolved from the same bib files, shared by the old and new revision
+        self.bib_tables = {}
+
+        # contents of files included in the tex files (when flattening) and of bib files on disk, shared by the old
+        # and new revision
+        self.includes = {}
+
+        # cache of latexdiff output, opened when running latexdiff (or shared between jobs if set before)
+        self.diff_cache = None
+
+        # timings and counters of the stages not specific to a revision
+        self.stats = Stats()
+
+        # running latexdiff processes, killed when interrupted while latexdiff runs in other threads (after which no
+        # more are started)
+        self.processes = set()
+        self.processes_lock = threading.Lock()
+        self.interrupted = False
+
+        # temp files
+        self.tex_old_tmp_path = None
+        self.tex_old_tmp_hndl = None
+        self.tex_new_tmp_path = None
+        self.tex_new_tmp_hndl = None
+
+    @property
+    def revisions(self):
+        '''The old and new revision'''
+        return [self.old, self.new]
+
+    def create_tempfiles(self):
         '''Create temporary .tex files'''
         for rev in ['new', 'old']:
-            tmpfile = tempfile.NamedTemporaryFile(delete=False, prefix='tmp_' + rev + '_', suffix='.tex')
+            tmpfile = tempfile.NamedTemporaryFile(delete=False, prefix='tmp_' + rev + '_', suffix='.tex',
+                                                  dir=self.config.temp_dir or None)
             log.debug('created temp file %s', tmpfile.name)
-            setattr(Files, 'tex_' + rev + '_tmp_path', tmpfile.name)
-            setattr(Files, 'tex_' + rev + '_tmp_hndl', tmpfile)
+            setattr(self, 'tex_' + rev + '_tmp_path', tmpfile.name)
+            setattr(self, 'tex_' + rev + '_tmp_hndl', tmpfile)
 
-    @staticmethod
-    def destroy_tempfiles():
+    def destroy_tempfiles(self):
         '''Delete temporary .tex files'''
-        log.debug('deleting temp file %s', Files.tex_old_tmp_path)
-        Files.tex_old_tmp_hndl.close()
-        os.remove(Files.tex_old_tmp_path)
-        log.debug('deleting temp file %s', Files.tex_new_tmp_path)
-        Files.tex_new_tmp_hndl.close()
-        os.remove(Files.tex_new_tmp_path)
+        for rev in ['old', 'new']:
+            tmp_path = getattr(self, 'tex_' + rev + '_tmp_path')
+            if tmp_path is None:
+                continue
+            log.debug('deleting temp file %s', tmp_path)
+            getattr(self, 'tex_' + rev + '_tmp_hndl').close()
+            os.remove(tmp_path)
+            setattr(self, 'tex_' + rev + '_tmp_path', None)
+            setattr(self, 'tex_' + rev + '_tmp_hndl', None)
+
+
+class Revision(object):
+    '''Container for the paths, file contents and references of a single revision (old or new), and the settings
+    of its job. Holds no handles, so it can be sent to and from a worker process.'''
+
+    def __init__(self, name, tex_path, bbl_path=None, git_rev=None, config=None):
+        self.name = name
+        self.git_rev = git_rev
+        self.config = config or Config()
+
+        # paths
+        self.tex_path = tex_path
+        self.bbl_path = bbl_path
+        self.bib_paths = []
+
+        # file contents (multiple bib files supported, so use list of strings instead of single string)
+        self.tex = ''
+        self.bbl = ''
+        self.bib = []
+
+        # git object ids of the tex, bbl and bib files (only when read from git), equal ids mean identical contents
+        self.tex_oid = None
+        self.bbl_oid = None
+        self.bib_oids = []
+        self.include_oids = []
+
+        # citation commands, reference table (ordered dict of reference key -> number in order of appearance) and
+        # corresponding regex capture groups and author/year strings
+        self.citations = []
+        self.refkeys = collections.OrderedDict()
+        self.capture_groups = {}
+        self.authyear = {}
+
+        # formatted citation commands, ordered dict of (command, keys, prenote, postnote) -> string
+        self.formatted_refs = collections.OrderedDict()
+
+        # timings and counters of reading and processing
+        self.stats = Stats()
+
+
+class GitCatFile(object):
+    '''A long-lived git cat-file --batch process, through which any number of files are read from git'''
+
+    def __init__(self):
+        log.debug('starting git cat-file --batch')
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.bytes_read = 0
+
+    def read(self, fname, rev, force_unix_pathsep=True):
+        '''Returns tuple of (git object id, contents as bytes) of a file in a revision'''
+
+        return self.read_many([fname], rev, force_unix_pathsep)[0]
+
+    def read_many(self, fnames, rev, force_unix_pathsep=True, missing_ok=False):
+        '''Returns list of tuples of (git object id, contents as bytes) of files in a revision. All files are requested
+        before the first is read. Files that do not exist are returned as (None, None) if missing_ok.'''
+
+        # correct path separator
+        if force_unix_pathsep:
+            fnames = [fname.replace('\\', '/') for fname in fnames]
+
+        objs = ['{}:{}'.format(rev, fname) for fname in fnames]
+        log.debug('reading %s from git', ', '.join(objs))
+        if len(objs) == 1:
+            self.write_requests(objs)
+            responses = [self.read_response()]
+        else:
+            # write the requests in another thread, so that git is not blocked by a full pipe while they are written
+            writer = threading.Thread(target=self.write_requests, args=(objs,))
+            writer.start()
+            try:
+                responses = [self.read_response() for _ in objs]
+            finally:
+                writer.join()
+
+        # check the responses after all have been read, so that none are left in the pipe
+        results = []
+        for obj, (oid, obj_type, contents) in zip(objs, responses):
+            if oid is None:
+                if not missing_ok:
+                    # <object> missing or <object> ambiguous
+                    raise ValueError('git could not read {}: {}'.format(obj, obj_type))
+            elif obj_type != 'blob':
+                raise ValueError('{} is a {} in git, not a file'.format(obj, obj_type))
+            results.append((oid, contents))
+        return results
+
+    def write_requests(self, objs):
+        '''Requests objects from git'''
+        try:
+            for obj in objs:
+                self.process.stdin.write(obj.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            # git has exited, which is reported when reading the response
+            pass
+
+    def read_response(self):
+        '''Reads the next object from git, and returns tuple of (git object id, object type, contents as bytes), or
+        (None, reason, None) if the object does not exist'''
+
+        try:
+            # <oid> <type> <size>, or <object> missing or <object> ambiguous (where <object> may contain spaces)
+            header = self.process.stdout.readline().decode('utf-8').rsplit(None, 2)
+        except (IOError, OSError):
+            header = []
+        if not header:
+            # git has exited (e.g. not in a git repository)
+            ret_code = self.process.wait()
+            raise ValueError('git returned with code {}. Error from git:\n\n'.format(ret_code) +
+                             self.process.stderr.read().decode('utf-8', 'replace'))
+        if header[-1] in ['missing', 'ambiguous'] or len(header) != 3:
+            return None, header[-1], None
+        oid, obj_type, size = header
+        contents = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)  # newline after contents
+        self.bytes_read += len(contents)
+        return oid, obj_type, contents
+
+    def close(self):
+        '''Stops the git process'''
+        if self.process is None:
+            return
+        log.debug('stopping git cat-file --batch')
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            # git has already exited
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process = None
+
+
+class BibCache(object):
+    '''Persistent cache of parsed bib entries in a sqlite database in the cache directory.
+
+    Entries are stored per bib file content hash as reference key -> (surnames, year), or -> None if the key is not
+    in the file. Only looked-up keys are stored, and the least recently used bib files are evicted when the total
+    number of stored entries exceeds max_entries.'''
+
+    filename = 'bibcache.sqlite'
+    version = '1'
+
+    def __init__(self, cache_dir, max_entries):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # already exists (possibly created by another process)
+            if not os.path.isdir(cache_dir):
+                raise
+        self.path = os.path.join(cache_dir, self.filename)
+        self.max_entries = max_entries
+        self.pending = []
+        # time each bib file was last used, written with the pending entries (so no write transaction is left open
+        # while loading, which would lock the cache for other processes)
+        self.used = {}
+        log.debug('opening bib cache %s', self.path)
+        self.db = sqlite3.connect(self.path, timeout=60)
+
+        # check the version and create the tables in a single transaction, so that a process opening the cache at the
+        # same time waits for the tables instead of creating them again (and dropping those in use)
+        self.db.execute('BEGIN IMMEDIATE')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != self.version:
+                log.debug('bib cache has unknown version, clearing it')
+                self.db.execute('DROP TABLE IF EXISTS files')
+                self.db.execute('DROP TABLE IF EXISTS entries')
+                self.db.execute('CREATE TABLE files (digest TEXT PRIMARY KEY, last_used REAL)')
+                self.db.execute('CREATE TABLE entries (digest TEXT, refkey TEXT, surnames TEXT, year TEXT, '
+                                'PRIMARY KEY (digest, refkey))')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.version,))
+
+    def load(self, digest):
+        '''Returns dict of all cached entries for a bib file content hash, and marks the file as recently used'''
+        self.used[digest] = time.time()
+        entries = {}
+        for refkey, surnames, year in self.db.execute('SELECT refkey, surnames, year FROM entries WHERE digest = ?',
+                                                      (digest,)):
+            entries[refkey] = None if surnames is None else (json.loads(surnames), year)
+        log.debug('loaded %d cached entries for bib file %s', len(entries), digest)
+        return entries
+
+    def store(self, digest, refkey, entry):
+        '''Stores a parsed entry (or None if the key is not in the file), written to disk when closing'''
+        surnames, year = (None, None) if entry is None else (json.dumps(entry[0]), entry[1])
+        self.pending.append((digest, refkey, surnames, year))
+
+    def flush(self):
+        '''Writes pending entries and the times the bib files were used to disk'''
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?)', self.used.items())
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', self.pending)
+            self.pending = []
+            self.used = {}
+
+    def close(self):
+        '''Writes pending entries, evicts least recently used bib files if needed, and closes the database'''
+        self.flush()
+        with self.db:
+            n_entries = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            for digest, in self.db.execute('SELECT digest FROM files ORDER BY last_used').fetchall():
+                if n_entries <= self.max_entries:
+                    break
+                log.debug('evicting bib file %s from cache', digest)
+                n_entries -= self.db.execute('DELETE FROM entries WHERE digest = ?', (digest,)).rowcount
+                self.db.execute('DELETE FROM files WHERE digest = ?', (digest,))
+        self.db.close()
+
+
+class BatchWorker(object):
+    '''Container for the bib cache, parsed bib files and resolved references shared by the batch jobs run in the same
+    process. The cache is opened by the first job.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.bib_cache = None
+        self.bib_files = {}
+        self.bib_tables = {}
+
+    def close(self):
+        '''Writes and closes the bib cache, and releases the parsed bib files'''
+        close_cache(self.bib_cache)
+        close_bib_files(self.bib_files)
+        self.bib_cache = None
+
+
+# the batch worker of a worker process, set by init_batch_worker() (not used in the main process)
+batch_worker = None
+
 
+class BibFile(object):
+    '''Contents of a bib file with lookup of parsed entries by reference key. The file is identified in the cache by
+    digest (default: hash of the contents), indexed on the first lookup that is not found in the cache, and only
+    looked-up entries are parsed. Subclasses reading the file from disk pass contents None, and have no digest until
+    the file is read if they do not pass one either.'''
 
-class FileContents(object):
-    '''Container for file contents (multiple bib files supported, so use list of strings instead of single string)'''
+    def __init__(self, contents, cache=None, digest=None):
+        self.contents = contents
+        self.cache = cache
+        self.digest = digest or (BibFile.hash(contents) if contents is not None else None)
+        self.entries = cache.load(self.digest) if cache and self.digest else {}
+        self.index = None
+        self.n_parsed = 0
+        self.n_scanned = 0
 
-    tex_old = ''
-    tex_new = ''
-    bib_old = []
-    bib_new = []
-    bbl_old = ''
-    bbl_new = ''
+    @staticmethod
+    def hash(contents):
+        '''Returns the hash of the contents of a bib file'''
+        return hashlib.sha1(contents.encode('utf-8')).hexdigest()
+
+    def lookup(self, refkey):
+        '''Returns tuple of (list of surnames, year) for a reference key, or None if the key is not in the file'''
+        if refkey in self.entries:
+            return self.entries[refkey]
+        if self.index is None:
+            self.make_index()
+        if refkey in self.index:
+            start, end = self.index[refkey]
+            entry = parse_bib_entry(self.entry(start, end))
+            self.n_parsed += 1
+        else:
+            entry = None
+        self.entries[refkey] = entry
+        if self.cache:
+            self.cache.store(self.digest, refkey, entry)
+        return entry
+
+    def lookup_many(self, refkeys):
+        '''Returns dict of reference key -> (list of surnames, year) for those of refkeys that are in the file'''
+        found = {}
+        for refkey in refkeys:
+            entry = self.lookup(refkey)
+            if entry is not None:
+                found[refkey] = entry
+        return found
+
+    def make_index(self):
+        '''Indexes the entries of the file'''
+        self.index = index_bib_entries(self.contents)
+        self.n_scanned += len(self.index)
+
+    def entry(self, start, end):
+        '''Returns the text of the entry at span (start, end) in the index'''
+        return self.contents[start:end]
+
+    def close(self):
+        '''Releases resources held by the file (none for files read into memory). The file stays usable.'''
+        pass
+
+
+class MappedBibFile(BibFile):
+    '''A bib file on disk that is memory-mapped instead of read. The file is scanned once for the byte offsets of its
+    entries, and only the looked-up entries are decoded. If index_dir is given, the offsets are stored there and
+    reused while the size and modification time of the file are unchanged. The file is identified in the cache by
+    its path, size and modification time, so it does not need to be read to find cached entries.'''
+
+    def __init__(self, path, encoding, cache=None, index_dir=None):
+        st = os.stat(path)
+        digest = 'file:{}:{}:{}:{}'.format(os.path.abspath(path), st.st_size, st.st_mtime, encoding)
+        BibFile.__init__(self, None, cache, digest)
+        self.path = path
+        self.encoding = encoding
+        self.index_dir = index_dir
+        self.stat = [st.st_size, st.st_mtime]
+        self.map = None
+
+    def make_index(self):
+        '''Loads the index of the entries of the file from index_dir, or maps the file and scans it for them'''
+
+        index_path = None
+        if self.index_dir:
+            name = hashlib.sha1('{}:{}'.format(os.path.abspath(self.path), self.encoding).encode('utf-8')).hexdigest()
+            index_path = os.path.join(self.index_dir, name + '.json')
+            try:
+                with io.open(index_path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if saved['stat'] == self.stat:
+                    log.debug('loaded index of bib file %s from %s', self.path, index_path)
+                    self.index = dict((k, tuple(v)) for k, v in saved['index'].items())
+                    return
+            except (IOError, OSError, ValueError, KeyError):
+                # no index, or an index of another version of the file
+                pass
+
+        self.open()
+        self.index = index_bib_entries(self.map, self.encoding)
+        self.n_scanned += len(self.index)
+
+        if index_path:
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+            with io.open(fd, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'path': os.path.abspath(self.path), 'stat': self.stat, 'index': self.index}))
+            os.replace(tmp_path, index_path)
+
+    def entry(self, start, end):
+        '''Returns the decoded text of the entry at byte offsets (start, end) in the index'''
+        self.open()
+        return self.map[start:end].decode(self.encoding).replace('\r\n', '\n')
+
+    def open(self):
+        '''Maps the file, unless it is mapped already'''
+        if self.map is None:
+            log.debug('mapping bib file %s', self.path)
+            with io.open(self.path, 'rb') as f:
+                # an empty file cannot be mapped
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.stat[0] else b''
+
+    def close(self):
+        '''Unmaps the file. It is mapped again if needed by a later lookup.'''
+        if self.map is not None:
+            log.debug('unmapping bib file %s', self.path)
+            if self.stat[0]:
+                self.map.close()
+            self.map = None
+
+
+class StreamedBibFile(BibFile):
+    '''A bib file on disk that is read line by line instead of into memory. Only the cited entries are kept, so the
+    memory used is bounded by the number of cited entries, not the size of the file. The file is identified in the
+    cache by the hash of its contents, computed while reading it.'''
+
+    def __init__(self, path, encoding, cache=None):
+        BibFile.__init__(self, None, cache)
+        self.path = path
+        self.encoding = encoding
+
+    def prefetch(self, refkeys):
+        '''Reads the file once and parses the entries of those reference keys that have not been looked up before'''
+
+        wanted = set(refkeys).difference(self.entries)
+        if not wanted:
+            return
+        log.debug('reading bib file %s for %d reference keys', self.path, len(wanted))
+        sha1 = hashlib.sha1()
+        found = {}
+        with io.open(self.path, 'r', encoding=self.encoding) as f:
+            for refkey, entry in iter_bib_entries(f, wanted, sha1.update):
+                self.n_scanned += 1
+                if entry is not None and refkey not in found:
+                    found[refkey] = entry
+
+        # entries of the file that are in the cache do not need to be parsed
+        if self.digest is None:
+            self.digest = sha1.hexdigest()
+            if self.cache:
+                self.entries.update(self.cache.load(self.digest))
+        for refkey in wanted.difference(self.entries):
+            entry = found.get(refkey)
+            if entry is not None:
+                entry = parse_bib_entry(entry)
+                self.n_parsed += 1
+            self.entries[refkey] = entry
+            if self.cache:
+                self.cache.store(self.digest, refkey, entry)
+
+    def lookup(self, refkey):
+        '''Returns tuple of (list of surnames, year) for a reference key, or None if the key is not in the file'''
+        if refkey not in self.entries:
+            self.prefetch([refkey])
+        return self.entries[refkey]
+
+    def lookup_many(self, refkeys):
+        '''Returns dict of reference key -> (list of surnames, year) for those of refkeys that are in the file, reading
+        the file at most once'''
+        self.prefetch(refkeys)
+        return BibFile.lookup_many(self, refkeys)
+
+
+class DiffCache(object):
+    '''Persistent cache of latexdiff output in the diffs subdirectory of the cache directory.
+
+    Outputs are stored by a hash of both processed tex files, the latexdiff arguments, the latexdiff version and
+    whether latexdiff was run on the whole documents or on each changed section (--chunked).
+    Outputs not used for max_days are evicted, and the least recently used outputs are evicted when the total size
+    exceeds max_mb.'''
+
+    dirname = 'diffs'
+
+    def __init__(self, cache_dir, max_mb, max_days):
+        self.path = os.path.join(cache_dir, self.dirname)
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            # already exists (possibly created by another process)
+            if not os.path.isdir(self.path):
+                raise
+        self.max_bytes = max_mb*1024*1024
+        self.max_age = max_days*24*60*60
+        self.latexdiff_version = None
+
+    def key(self, job):
+        '''Returns the key of the latexdiff output of a job with processed revisions, or None if the version of
+        latexdiff cannot be determined'''
+        if self.latexdiff_version is None:
+            self.latexdiff_version = get_latexdiff_version()
+            if self.latexdiff_version is None:
+                return None
+        h = hashlib.sha1()
+        for part in [job.old.tex, job.new.tex, job.config.latexdiff_args, self.latexdiff_version,
+                     'chunked' if job.chunked else 'whole']:
+            data = part.encode('utf-8')
+            h.update('{}:'.format(len(data)).encode('ascii') + data)
+        return h.hexdigest()
+
+    def get(self, key, out_path):
+        '''Copies the cached output for key to out_path, and returns True if found'''
+        path = os.path.join(self.path, key + '.tex')
+        if not os.path.isfile(path):
+            return False
+        shutil.copyfile(path, out_path)
+        os.utime(path, None)
+        return True
+
+    def put(self, key, out_path):
+        '''Stores out_path as the output for key, and evicts old outputs if needed'''
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(out_path, tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, key + '.tex'))
+        self.evict()
+
+    def evict(self):
+        '''Removes outputs not used for max_days, and the least recently used outputs exceeding max_mb'''
+        outputs = []
+        for fname in os.listdir(self.path):
+            if fname.endswith('.tex'):
+                try:
+                    stat = os.stat(os.path.join(self.path, fname))
+                except OSError:
+                    # removed by another process
+                    continue
+                outputs.append((stat.st_mtime, stat.st_size, fname))
+        now = time.time()
+        total_size = 0
+        for mtime, size, fname in sorted(outputs, reverse=True):
+            total_size += size
+            if now - mtime > self.max_age or total_size > self.max_bytes:
+                log.debug('evicting latexdiff output %s from cache', fname)
+                try:
+                    os.remove(os.path.join(self.path, fname))
+                except OSError:
+                    pass
 
 
 # ==============================================================================
@@ -174,9 +747,33 @@ def main(args=None):
 
     parser = create_parser()
     parsed_args = parser.parse_args(args)
-    initiate_from_args(parsed_args)
-    run(parsed_args)
-    log.info('all done!')
+    logging_state = setup_logging(parsed_args)
+    signal_handlers = setup_signals()
+    try:
+        if parsed_args.subcommand == 'batch':
+            return run_batch(parsed_args)
+        if parsed_args.subcommand == 'git' and parsed_args.rev_range:
+            if parsed_args.rev_new is not None or parsed_args.file_new is not None:
+                parser.error('REV_NEW and FILE_NEW cannot be used with --range')
+            for option, value in [('--preprocess-only', parsed_args.preprocess_only), ('-P', parsed_args.parallel),
+                                  ('--bbl2', parsed_args.bbl2_path is not None)]:
+                if value:
+                    parser.error('{} cannot be used with --range'.format(option))
+            run_range_from_args(parsed_args)
+            log.info('all done!')
+            return
+        job = initiate_from_args(parsed_args)
+        if parsed_args.preprocess_only:
+            process_job(job)
+            write_processed(job, *parsed_args.preprocess_only)
+        else:
+            run(job)
+        if parsed_args.file_stats:
+            write_stats(job, parsed_args.file_stats)
+        log.info('all done!')
+    finally:
+        remove_signals(signal_handlers)
+        remove_logging(logging_state)
 
 
 def create_parser():
@@ -187,23 +784,33 @@ def create_parser():
 
     parser.add_argument('--version', action='version', version='latexdiffcite version {}'.format(__version__))
 
-    # add subparsers: file, git
+    # add subparsers: file, git, batch
     subparsers = parser.add_subparsers(title='Subcommands', dest='subcommand',
                                        description='for help, run %(prog)s SUBCOMMAND -h')
     subparsers.required = True
     parser_file = subparsers.add_parser('file', help='compare two files')
     parser_git = subparsers.add_parser('git', help='compare revisions of a file in a git repository')
+    parser_batch = subparsers.add_parser('batch', help='compare many pairs of files listed in a manifest')
 
     # add argument common to all subcommands
-    for p in [parser_file, parser_git]:
+    for p in [parser_file, parser_git, parser_batch]:
         p.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='show debug log on screen')
         p.add_argument('-l', '--log', dest='log', metavar='LOGFILE', nargs='?', default=False,
                        const='latexdiffcite.log', help='enable logging to LOGFILE, default %(const)s')
         p.add_argument('-s', '--silent', dest='silent', action='store_true', default=False, help='only show warnings on screen')
-        p.add_argument('-o', '--output', dest='file_out', metavar='FILE_OUT',
-                       default='diff.tex', help='output file, default %(default)s')
         p.add_argument('-c', '--config', dest='file_config', metavar='CONFIG_FILE',
                        help='config file, see documentation for options')
+        p.add_argument('--cache-dir', dest='cache_dir', metavar='CACHE_DIR', default=None,
+                       help='directory for caching parsed bib files between runs (overrides cache_dir in the config)')
+        p.add_argument('--no-cache', dest='no_cache', action='store_true', default=False,
+                       help='do not use the cache of parsed bib files')
+        p.add_argument('--flatten', dest='flatten', action='store_true', default=False,
+                       help='replace \\input, \\include and \\subfile commands by the contents of the files (recursively)')
+
+    # add arguments common to the subcommands comparing a single pair
+    for p in [parser_file, parser_git]:
+        p.add_argument('-o', '--output', dest='file_out', metavar='FILE_OUT',
+                       default='diff.tex', help='output file, default %(default)s')
         p.add_argument('-b', '--bbl', dest='bbl_path', metavar='BBL_SUBDIR', default=None, nargs='?', const='',
                        help='path to where the bbl file resides (default: same directory as file). The filename is '
                             'assumed to be the same as the tex file. The bbl file will be used for formatting '
@@ -213,6 +820,20 @@ def create_parser():
                             'documentation for details')
         p.add_argument('--bbl2', dest='bbl2_path', metavar='BBL_NEW_SUBDIR', default=None, nargs='?', const='',
                        help='Path to where the new bbl file resides if different from old bbl file.')
+        p.add_argument('-P', '--parallel', dest='parallel', action='store_true', default=False,
+                       help='read and process the old and new revisions in parallel in separate processes')
+        p.add_argument('--chunked', dest='chunked', action='store_true', default=False,
+                       help='run latexdiff separately on each chapter (or section if there are no chapters), aligned '
+                            'by heading, and skip unchanged chapters')
+        p.add_argument('--stats', dest='file_stats', metavar='STATS_FILE', default=None,
+                       help='write timings and counters of each stage to STATS_FILE as JSON (a list with one entry '
+                            'for each pair with --range)')
+        p.add_argument('--preprocess-only', dest='preprocess_only', nargs=2, metavar=('OLD_OUT', 'NEW_OUT'),
+                       default=None, help='only replace references, and write the old and new revisions to OLD_OUT '
+                                          'and NEW_OUT (- for stdout) instead of running latexdiff')
+        p.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int, default=None,
+                       help='with --chunked or --range, number of latexdiff processes to run at once, default number '
+                            'of CPUs')
 
     # add positional arguments to file subcommand
     parser_file.add_argument('file_old', metavar='FILE_OLD', help='old revision')
@@ -221,28 +842,40 @@ def create_parser():
     # add positional arguments to git subcommand
     parser_git.add_argument('file_old', metavar='FILE', help='file to process (from base of git repository)')
     parser_git.add_argument('rev_old', metavar='REV_OLD', help='commit/tag/branch to use as base')
-    parser_git.add_argument('rev_new', metavar='REV_NEW', nargs='?', default='HEAD',
-                            help='commit/tag/branch to use as base, default %(default)s')
+    parser_git.add_argument('rev_new', metavar='REV_NEW', nargs='?', default=None,
+                            help='commit/tag/branch to use as base, default HEAD')
     parser_git.add_argument('file_new', metavar='FILE_NEW', nargs='?', default=None,
                             help='use if new revision has another filename')
+    parser_git.add_argument('-R', '--range', dest='rev_range', action='store_true', default=False,
+                            help='REV_OLD is a revision range (e.g. v1.0..HEAD): diff each commit in the range against '
+                                 'its parent, writing FILE_OUT with the commit ids appended to the filename')
+
+    # add arguments to batch subcommand
+    parser_batch.add_argument('manifest', metavar='MANIFEST',
+                              help='JSON file with a list of jobs, see documentation for details')
+    parser_batch.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int, default=None,
+                              help='number of worker processes, default number of CPUs')
+    parser_batch.add_argument('-r', '--report', dest='file_report', metavar='REPORT_FILE', default=None,
+                              help='write status of each job to REPORT_FILE as JSON')
 
     return parser
 
 
-def initiate_from_args(args):
-    '''Sets up logging and file paths, and loads config'''
+def setup_logging(args):
+    '''Sets up logging to terminal and (optionally) to file, and returns tuple of (added handlers, previous level of
+    the logger) to be passed to remove_logging()'''
 
-    # set up logging
+    level = log.level
     log.setLevel(logging.DEBUG)
-    log.addHandler(logging.NullHandler())
     formatter_full = logging.Formatter('[%(filename)s:%(lineno)4s %(funcName)28s() ] %(levelname)8s  %(message)s')
     formatter_info = logging.Formatter('%(message)s')
+    handlers = []
     # set up logging to file
     if args.log:
         hdlr_file = logging.FileHandler(args.log, mode='w')
         hdlr_file.setFormatter(formatter_full)
         hdlr_file.setLevel(logging.DEBUG)
-        log.addHandler(hdlr_file)
+        handlers.append(hdlr_file)
     # set up logging to terminal
     hdlr_stream = logging.StreamHandler()
     if args.verbose:
@@ -254,158 +887,747 @@ def initiate_from_args(args):
     else:
         hdlr_stream.setLevel(logging.INFO)
         hdlr_stream.setFormatter(formatter_info)
-    log.addHandler(hdlr_stream)
+    handlers.append(hdlr_stream)
+    for handler in handlers:
+        log.addHandler(handler)
+    return handlers, level
+
+
+def remove_logging(logging_state):
+    '''Removes and closes the handlers added by setup_logging(), and restores the level of the logger, given the
+    tuple returned by setup_logging()'''
+
+    handlers, level = logging_state
+    for handler in handlers:
+        log.removeHandler(handler)
+        handler.close()
+    log.setLevel(level)
+
+
+def setup_signals():
+    '''Makes SIGTERM and SIGHUP raise SystemExit, so that temp files are removed when terminated, and returns the
+    previous signal handlers. Signal handlers can only be set in the main thread, so nothing is done elsewhere.'''
+
+    previous = {}
+    if threading.current_thread() is not threading.main_thread():
+        return previous
+    for name in ['SIGTERM', 'SIGHUP']:
+        if hasattr(signal, name):
+            signum = getattr(signal, name)
+            previous[signum] = signal.signal(signum, exit_on_signal)
+    return previous
+
+
+def exit_on_signal(signum, frame):
+    '''Signal handler raising SystemExit'''
+
+    log.warning('terminated by signal %d, cleaning up', signum)
+    raise SystemExit(128 + signum)
+
+
+def remove_signals(previous):
+    '''Restores signal handlers replaced by setup_signals()'''
+
+    for signum, handler in previous.items():
+        signal.signal(signum, handler)
+
+
+def initiate_from_args(args):
+    '''Sets up file paths and loads config, and returns the job'''
+
+    git_revs = [args.rev_old, args.rev_new or 'HEAD'] if args.subcommand == 'git' else None
+    return create_job(args.file_old, args.file_new, args.file_out, args.file_config, args.bbl_path, args.bbl2_path,
+                      git_revs, args.cache_dir, args.no_cache, args.parallel, args.chunked, args.jobs, args.flatten)
+
+
+def create_job(file_old, file_new=None, file_out='diff.tex', file_config=None, bbl_path=None, bbl2_path=None,
+               git_revs=None, cache_dir=None, no_cache=False, parallel=False, chunked=False, max_workers=None,
+               flatten=False):
+    '''Sets up file paths and loads config as given on the command line, and returns the job'''
 
     # paths of tex files
-    Files.tex_old_path = args.file_old
-    Files.tex_new_path = args.file_new or args.file_old
-    log.debug('Old tex path: %s', Files.tex_old_path)
-    log.debug('New tex path: %s', Files.tex_new_path)
+    tex_old_path = file_old
+    tex_new_path = file_new or file_old
+    log.debug('Old tex path: %s', tex_old_path)
+    log.debug('New tex path: %s', tex_new_path)
 
     # path to bbl files
-    if args.bbl2_path is None:
-        args.bbl2_path = args.bbl_path
-    if args.bbl_path is not None:
-        args.bbl_path = os.path.join(os.path.dirname(Files.tex_old_path), args.bbl_path)
-        args.bbl2_path = os.path.join(os.path.dirname(Files.tex_new_path), args.bbl2_path)
-        bbl_filename = os.path.splitext(os.path.basename(Files.tex_old_path))[0] + '.bbl'
-        bbl2_filename = os.path.splitext(os.path.basename(Files.tex_new_path))[0] + '.bbl'
-        Files.bbl_old_path = os.path.join(args.bbl_path, bbl_filename)
-        Files.bbl_new_path = os.path.join(args.bbl2_path, bbl2_filename)
-        log.debug('Old bbl path: %s', Files.bbl_old_path)
-        log.debug('New bbl path: %s', Files.bbl_new_path)
+    if bbl2_path is None:
+        bbl2_path = bbl_path
+    bbl_old_path = find_bbl_path(tex_old_path, bbl_path)
+    bbl_new_path = find_bbl_path(tex_new_path, bbl2_path)
+    if bbl_path is not None:
+        log.debug('Old bbl path: %s', bbl_old_path)
+        log.debug('New bbl path: %s', bbl_new_path)
 
     # path to output file
-    Files.out_path = args.file_out
-    log.debug('Output path: %s', Files.out_path)
+    log.debug('Output path: %s', file_out)
+
+    config = load_config(file_config, cache_dir, no_cache, flatten)
+    return DiffJob(tex_old_path, tex_new_path, file_out, config, bbl_old_path, bbl_new_path, git_revs, parallel,
+                   chunked, max_workers)
+
 
-    # load config
-    Config.load_defaults()
+def find_bbl_path(tex_path, bbl_subdir):
+    '''Returns path of the bbl file for a tex file, in bbl_subdir relative to the tex file, or None if bbl_subdir is
+    None (bib mode)'''
+
+    if bbl_subdir is None:
+        return None
+    bbl_dir = os.path.join(os.path.dirname(tex_path), bbl_subdir)
+    bbl_filename = os.path.splitext(os.path.basename(tex_path))[0] + '.bbl'
+    return os.path.join(bbl_dir, bbl_filename)
+
+
+def load_config(file_config=None, cache_dir=None, no_cache=False, flatten=False):
+    '''Loads config from the defaults, ~/.latexdiffcite.json and file_config, and overrides the cache directory
+    and flattening as given on the command line'''
+
+    config = Config()
     default_cfile = os.path.expanduser(os.path.join('~', '.latexdiffcite.json'))
     if os.path.isfile(default_cfile):
         log.debug('Loading config from %s', default_cfile)
-        Config.load_config(default_cfile)
-    if args.file_config:
-        log.debug('Loading config from %s', args.file_config)
-        Config.load_config(args.file_config)
+        config.load_config(default_cfile)
+    if file_config:
+        log.debug('Loading config from %s', file_config)
+        config.load_config(file_config)
+
+    # cache directory from the command line overrides the config
+    if cache_dir is not None:
+        config.cache_dir = cache_dir
+    if no_cache:
+        config.cache_dir = ''
+    log.debug('Cache directory: %s', config.cache_dir or '(caching disabled)')
+    if flatten:
+        config.flatten = True
+    return config
+
+
+def run(job):
+    '''Replaces references in both revisions and runs latexdiff'''
 
+    process_job(job)
+    with job.stats.timer('diff'):
+        diff_revisions(job)
 
-def run(args):
-    '''Replaces references in both revisions and runs latexdiff'''
 
-    if args.subcommand == 'file':
-        # read revisions from disk
-        read_files('tex')
-        if Files.bbl_old_path and Files.bbl_new_path:
-            read_files('bbl')
-    else:
-        # read revisions from git
-        log.debug('getting revisions from git')
-        git_extract('tex', [args.rev_old, args.rev_new])
-        if Files.bbl_old_path and Files.bbl_new_path:
-            git_extract('bbl', [args.rev_old, args.rev_new])
+def process_job(job):
+    '''Reads both revisions and replaces references in them'''
+
+    # a cache set before running is shared with other jobs and is not closed here
+    own_cache = job.bib_cache is None
 
     # process the files
     try:
-        Files.create_tempfiles()
-        process_revision('old')
-        process_revision('new')
-        run_latexdiff(Files.tex_old_tmp_path, Files.tex_new_tmp_path)
+        with job.stats.timer('process'):
+            if job.parallel:
+                job.old, job.new = process_revisions_in_parallel(job.revisions)
+            else:
+                read_revisions(job)
+                if own_cache:
+                    job.bib_cache = open_cache(job.config)
+                for rev in job.revisions:
+                    process_revision(rev, job.bib_cache, job.bib_files, job.bib_tables)
     finally:
-        Files.destroy_tempfiles()
+        # the parsed bib files may be kept (e.g. by a batch worker), but not their memory maps
+        close_bib_files(job.bib_files)
+        if own_cache:
+            close_cache(job.bib_cache)
+            job.bib_cache = None
+
+
+def job_stats(job):
+    '''Returns timings and counters of a job and its revisions as dict'''
+
+    stats = job.stats.as_dict()
+    stats['output'] = job.out_path
+    stats['revisions'] = {}
+    for name, rev in zip(['old', 'new'], job.revisions):
+        stats['revisions'][name] = rev.stats.as_dict()
+        stats['revisions'][name].update({'path': rev.tex_path, 'git_rev': rev.git_rev})
+    return stats
+
+
+def write_stats(job, fname):
+    '''Writes timings and counters of a job and its revisions to fname as JSON'''
+
+    log.debug('writing stats to %s', fname)
+    with io.open(fname, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(job_stats(job), indent=4, ensure_ascii=False))
+
+
+def write_processed(job, old_path, new_path):
+    '''Writes the processed old and new revisions to old_path and new_path, or to stdout if a path is -'''
+
+    for path, rev in zip([old_path, new_path], job.revisions):
+        if path == '-':
+            log.debug('writing processed %s revision to stdout', rev.name)
+            stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+            stdout.write(rev.tex.encode('utf-8'))
+            stdout.flush()
+        else:
+            log.debug('writing processed %s revision to %s', rev.name, path)
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(rev.tex)
+
+
+def diff_revisions(job):
+    '''Writes the processed revisions of a job to temp files and runs latexdiff on them, or copies the output from
+    the cache if latexdiff has been run on the same input before'''
+
+    # nothing to diff if the revisions are identical after processing
+    if job.old.tex == job.new.tex:
+        job.stats.count('identical')
+        log.info('old and new revisions are identical, writing %s without running latexdiff',
+                 'no_change_marker' if job.config.no_change_marker else 'processed file')
+        with io.open(job.out_path, 'w', encoding='utf-8') as f:
+            f.write(job.config.no_change_marker or job.new.tex)
+        return
+
+    diff_cache = job.diff_cache or open_diff_cache(job.config)
+    key = diff_cache.key(job) if diff_cache else None
+    if key and diff_cache.get(key, job.out_path):
+        job.stats.count('diff_cache_hits')
+        log.info('latexdiff output found in cache, copied to %s', job.out_path)
+        return
+
+    if job.chunked and run_latexdiff_chunked(job):
+        pass
+    elif use_fifo(job.config):
+        run_latexdiff_fifo(job, job.old.tex, job.new.tex)
+    else:
+        try:
+            with job.stats.timer('write_temp'):
+                job.create_tempfiles()
+                for name in ['old', 'new']:
+                    write_tex_to_temp(job, name)
+            run_latexdiff(job, job.tex_old_tmp_path, job.tex_new_tmp_path)
+        finally:
+            job.destroy_tempfiles()
+
+    if key:
+        log.debug('storing latexdiff output in cache')
+        diff_cache.put(key, job.out_path)
+
+
+def read_revisions(job):
+    '''Reads both revisions of a job, through a single git cat-file process if reading from git'''
+
+    git = None
+    if any(rev.git_rev is not None for rev in job.revisions):
+        git = GitCatFile()
+    try:
+        for rev in job.revisions:
+            read_revision(rev, git, job.includes)
+    finally:
+        if git:
+            git.close()
+    if job.old.tex_oid is not None and job.old.tex_oid == job.new.tex_oid:
+        log.debug('old and new tex files are identical (git object %s)', job.old.tex_oid)
+
+
+def open_cache(config):
+    '''Opens and returns the cache of parsed bib files, or None if caching is disabled'''
+
+    if config.cache_dir:
+        return BibCache(os.path.expanduser(config.cache_dir), config.cache_max_entries)
+    return None
+
+
+def open_diff_cache(config):
+    '''Returns the cache of latexdiff output, or None if caching is disabled'''
+
+    if config.cache_dir:
+        return DiffCache(os.path.expanduser(config.cache_dir), config.diff_cache_max_mb, config.diff_cache_max_days)
+    return None
+
 
+def close_cache(cache):
+    '''Writes and closes the cache of parsed bib files if it is open'''
 
-def read_files(ext):
-    '''Reads the original files'''
+    if cache:
+        cache.close()
 
-    for rev in ['old', 'new']:
-        fname = getattr(Files, '{ext}_{rev}_path'.format(ext=ext, rev=rev))
-        log.debug('reading %s', fname)
-        with io.open(fname, 'r', encoding=Config.encoding) as f:
-            setattr(FileContents, '{ext}_{rev}'.format(ext=ext, rev=rev), f.read())
 
+def run_range_from_args(args):
+    '''Loads config and diffs each commit in the revision range given on the command line against its parent'''
 
-def git_extract(ext, revs):
-    '''Extracts revision from git using git show'''
+    config = load_config(args.file_config, args.cache_dir, args.no_cache, args.flatten)
+    bbl_path = find_bbl_path(args.file_old, args.bbl_path)
+    return run_range(args.file_old, args.rev_old, args.file_out, config, bbl_path, args.jobs, args.chunked,
+                     args.file_stats)
 
-    for oldnew, rev in zip(['old', 'new'], revs):
-        fname = getattr(Files, '{ext}_{oldnew}_path'.format(ext=ext, oldnew=oldnew))
-        log.debug('running git show %s:%s', rev, fname)
-        contents = git_show(fname, rev).decode(Config.encoding).replace('\r\n', '\n')
-        setattr(FileContents, '{ext}_{oldnew}'.format(ext=ext, oldnew=oldnew), contents)
 
+def run_range(fname, rev_range, out_path='diff.tex', config=None, bbl_path=None, max_workers=None, chunked=False,
+              stats_path=None):
+    '''Diffs each commit in a git revision range against its (first) parent and returns the output paths. The output
+    of each pair is written to out_path with the short commit ids appended to the filename.
 
-def git_show(fname, rev):
-    '''Runs git show and returns stdout'''
+    Each commit is read and processed only once, also if it is part of two pairs, and commits where the tex, bbl,
+    bib and included files are identical share the processed revision. Bib files are shared between all commits by git object id,
+    so an unchanged bib file is only parsed once. latexdiff is run for up to max_workers pairs at once, or if chunked,
+    for up to max_workers changed sections of one pair at once. If stats_path is given, a list of the timings and
+    counters of each pair is written there as JSON.'''
 
-    # correct path separator
-    if Config.git_force_unix_pathsep:
-        fname = fname.replace('\\', '/')
+    config = config or Config()
+    pairs = git_rev_pairs(rev_range)
+    if not pairs:
+        raise ValueError('no commits with a parent in revision range {}'.format(rev_range))
+    log.info('diffing %d commits in %s', len(pairs), rev_range)
 
-    # run git show
-    process = subprocess.Popen(['git', 'show', '{}:{}'.format(rev, fname)],
+    # read each commit once, through a single git process
+    revs = collections.OrderedDict()
+    includes = {}
+    git = GitCatFile()
+    try:
+        for commit in itertools.chain.from_iterable(pairs):
+            if commit not in revs:
+                revs[commit] = Revision(commit[:7], fname, bbl_path, commit, config)
+                read_revision(revs[commit], git, includes)
+    finally:
+        git.close()
+
+    # process each distinct revision once
+    processed = {}
+    bib_files = {}
+    bib_tables = {}
+    bib_cache = open_cache(config)
+    try:
+        for commit, rev in revs.items():
+            key = (rev.tex_oid, rev.bbl_oid, tuple(rev.bib_oids), tuple(rev.include_oids))
+            if key in processed:
+                # the commit keeps its own name, git revision and stats (of reading it)
+                log.debug('%s revision is identical to %s revision', rev.name, processed[key].name)
+                for attr in ['tex', 'citations', 'refkeys', 'capture_groups', 'authyear']:
+                    setattr(rev, attr, getattr(processed[key], attr))
+            else:
+                process_revision(rev, bib_cache, bib_files, bib_tables)
+                processed[key] = rev
+    finally:
+        close_bib_files(bib_files)
+        close_cache(bib_cache)
+
+    # run latexdiff on each pair
+    stem, ext = os.path.splitext(out_path)
+    diff_cache = open_diff_cache(config)
+    jobs = []
+    for old, new in pairs:
+        job = DiffJob(fname, fname, '{}_{}_{}{}'.format(stem, old[:7], new[:7], ext), config, git_revs=[old, new],
+                      chunked=chunked, max_workers=max_workers)
+        job.old, job.new = revs[old], revs[new]
+        job.diff_cache = diff_cache
+        jobs.append(job)
+    # chunked pairs are diffed one at a time, each running latexdiff on its sections in parallel
+    n_workers = 1 if chunked else max_workers or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(diff_revisions, job) for job in jobs]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            cancel_latexdiff(futures, jobs)
+            raise
+    if stats_path:
+        log.debug('writing stats to %s', stats_path)
+        with io.open(stats_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps([job_stats(job) for job in jobs], indent=4, ensure_ascii=False))
+    return [job.out_path for job in jobs]
+
+
+def git_rev_pairs(rev_range):
+    '''Returns list of (parent, commit) for each commit in a git revision range, oldest first. Only the first parent
+    of merge commits is followed, and root commits (without parent) are skipped.'''
+
+    log.debug('running git rev-list %s', rev_range)
+    process = subprocess.Popen(['git', 'rev-list', '--reverse', '--first-parent', '--parents', rev_range],
                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
     ret_code = process.wait()
     if ret_code:
-        raise ValueError('git returned with code {}. Error from git:\n\n'.format(ret_code) + stderr)
-    return stdout
+        raise ValueError('git returned with code {}. Error from git:\n\n'.format(ret_code) +
+                         stderr.decode('utf-8', 'replace'))
+    pairs = []
+    for line in stdout.decode('ascii').splitlines():
+        commits = line.split()
+        if len(commits) < 2:
+            log.info('skipping root commit %s', commits[0])
+            continue
+        pairs.append((commits[1], commits[0]))
+    return pairs
+
+
+def process_revisions_in_parallel(revisions):
+    '''Reads and processes the revisions in separate worker processes, and returns the processed revisions'''
+
+    log.debug('processing revisions in parallel')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(revisions)) as executor:
+        futures = [executor.submit(process_revision_worker, rev) for rev in revisions]
+        return [future.result() for future in futures]
+
+
+def process_revision_worker(rev):
+    '''Reads and processes a revision in a worker process, and returns the revision'''
+
+    cache = open_cache(rev.config)
+    try:
+        read_revision(rev)
+        process_revision(rev, cache)
+    finally:
+        close_cache(cache)
+
+    # the bib contents are not needed anymore, so don't send them back
+    rev.bib = []
+    return rev
+
+
+def run_batch(args):
+    '''Runs all jobs in a batch manifest on a pool of worker processes and reports the status of each job.
+    Returns the exit code: 0 if all jobs succeeded, otherwise 1.'''
+
+    entries = read_manifest(args.manifest)
+    config = load_config(args.file_config, args.cache_dir, args.no_cache, args.flatten)
+    defaults = {'file_config': args.file_config, 'cache_dir': args.cache_dir, 'no_cache': args.no_cache,
+                'flatten': args.flatten}
+    n_workers = min(args.jobs or os.cpu_count() or 1, len(entries)) or 1
+    log.info('running %d jobs with %d worker processes', len(entries), n_workers)
+
+    if n_workers == 1:
+        # no need for worker processes
+        worker = BatchWorker(config)
+        try:
+            results = [run_batch_entry(entry, defaults, worker) for entry in entries]
+        finally:
+            worker.close()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, initializer=init_batch_worker,
+                                                    initargs=(config,)) as executor:
+            results = list(executor.map(run_batch_entry, entries, [defaults]*len(entries)))
+        # the workers only write to the cache, so evict old entries here (errors of the cache are reported by the jobs)
+        try:
+            close_cache(open_cache(config))
+        except (OSError, sqlite3.Error) as e:
+            log.warning('could not evict old entries from the bib cache: %s', e)
+
+    # report status of each job
+    report = []
+    for i, (entry, (error, stats)) in enumerate(zip(entries, results)):
+        if error is None:
+            log.info('job %d (%s) done', i + 1, entry['output'])
+        else:
+            log.error('job %d (%s) failed: %s', i + 1, entry['output'], error)
+        report.append({'old': entry['old'], 'new': entry.get('new', entry['old']), 'output': entry['output'],
+                       'status': 'ok' if error is None else 'failed', 'exit_code': int(error is not None),
+                       'error': error, 'stats': stats})
+    if args.file_report:
+        log.debug('writing report to %s', args.file_report)
+        with io.open(args.file_report, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(report, indent=4, ensure_ascii=False))
+
+    n_failed = sum(error is not None for error, _ in results)
+    log.info('%d of %d jobs done, %d failed', len(entries) - n_failed, len(entries), n_failed)
+    return int(n_failed > 0)
+
+
+def read_manifest(fname):
+    '''Reads a batch manifest: a JSON list of jobs, each a dict with keys old, new, output, config, bbl, bbl2,
+    rev_old and rev_new (only old and output are required, and rev_old switches to git mode)'''
+
+    log.debug('reading manifest %s', fname)
+    with io.open(fname, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError('Manifest {} must contain a list of jobs'.format(fname))
+    for i, entry in enumerate(entries):
+        missing = [k for k in ['old', 'output'] if k not in entry]
+        if missing:
+            raise ValueError('Job {} in manifest {} is missing {}'.format(i + 1, fname, ', '.join(missing)))
+    return entries
+
+
+def init_batch_worker(config):
+    '''Sets up a worker process for running batch jobs. The signal handlers of the main process are reset, so that
+    the worker is simply stopped when the pool terminates it.'''
+
+    global batch_worker
+    for name in ['SIGTERM', 'SIGHUP']:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+    batch_worker = BatchWorker(config)
+
+
+def run_batch_entry(entry, defaults, worker=None):
+    '''Runs a single job from a batch manifest, sharing the bib cache and bib files of worker (default: the batch
+    worker of this process), and returns tuple of (None if it succeeded or else the error message, stats of the job or
+    None if it could not be created). Errors of the cache are reported as errors of the job.'''
+
+    worker = worker or batch_worker
+    git_revs = [entry['rev_old'], entry.get('rev_new', 'HEAD')] if 'rev_old' in entry else None
+    job = None
+    try:
+        job = create_job(entry['old'], entry.get('new'), entry['output'], entry.get('config', defaults['file_config']),
+                         entry.get('bbl'), entry.get('bbl2'), git_revs, defaults['cache_dir'], defaults['no_cache'],
+                         flatten=defaults['flatten'])
+        if worker.bib_cache is None:
+            worker.bib_cache = open_cache(worker.config)
+        job.bib_cache = worker.bib_cache
+        job.bib_files = worker.bib_files
+        job.bib_tables = worker.bib_tables
+        try:
+            run(job)
+        finally:
+            if worker.bib_cache:
+                worker.bib_cache.flush()
+    except Exception as e:
+        log.debug(traceback.format_exc())
+        return '{}: {}'.format(type(e).__name__, e), job and job_stats(job)
+    return None, job_stats(job)
+
+
+def read_revision(rev, git=None, includes=None):
+    '''Reads the original tex file (flattened if set in the config) and the bbl file or bib files (if used) of a
+    revision from disk or from git. Files are read from git through git (a GitCatFile), or through a new git cat-file
+    process if not given. Included files and bib files on disk are looked up in includes (dict) before reading them,
+    if given.'''
+
+    if rev.git_rev is not None and git is None:
+        git = GitCatFile()
+        try:
+            return read_revision(rev, git, includes)
+        finally:
+            git.close()
+
+    if rev.git_rev is not None:
+        log.debug('getting %s revision from git', rev.name)
+    rev.tex_oid, rev.tex = read_source(rev, rev.tex_path, git)
+    if rev.config.flatten:
+        with rev.stats.timer('flatten'):
+            flatten_includes(rev, git, includes)
+    if rev.bbl_path:
+        rev.bbl_oid, rev.bbl = read_source(rev, rev.bbl_path, git)
+
+    # read bib files unless in bbl mode or %AUTHOR% and %YEAR% is not present in any formatting
+    if not rev.bbl:
+        if uses_author_year(rev.config):
+            read_bibfile(rev, git, includes)
+        else:
+            log.debug('%AUTHOR% and %YEAR% tokens not used in format, skipping reading of bib files')
+
+
+def read_source(rev, fname, git=None):
+    '''Reads a file of a revision from disk, or from git through git (a GitCatFile), and returns tuple of (git object
+    id or None, contents)'''
+
+    if rev.git_rev is None:
+        with rev.stats.timer('read'):
+            contents = read_file(fname, rev.config.encoding)
+        rev.stats.count('bytes_read', os.path.getsize(fname))
+        return None, contents
+    bytes_read = git.bytes_read
+    with rev.stats.timer('git_extract'):
+        oid, contents = git_extract(fname, rev.git_rev, rev.config, git)
+    rev.stats.count('bytes_read', git.bytes_read - bytes_read)
+    return oid, contents
+
+
+def read_file(fname, encoding):
+    '''Reads an original file'''
+
+    log.debug('reading %s', fname)
+    with io.open(fname, 'r', encoding=encoding) as f:
+        return f.read()
+
+
+def git_extract(fname, rev, config, git):
+    '''Extracts a file in a revision from git through git (a GitCatFile), and returns tuple of
+    (git object id, contents)'''
+
+    oid, contents = git.read(fname, rev, config.git_force_unix_pathsep)
+    return oid, contents.decode(config.encoding).replace('\r\n', '\n')
+
+
+# \input, \include and \subfile commands, or a comment (which is skipped)
+include_re = re.compile(r'%[^\n]*|\\(input|include|subfile)\s*{([^{}]*)}')
+
+
+def flatten_includes(rev, git=None, includes=None):
+    '''Replaces \\input, \\include and \\subfile commands in the tex file of a revision by the contents of the
+    included files, recursively. Paths are relative to the tex file, as when compiling it with LaTeX.'''
+
+    log.debug('flattening %s revision', rev.name)
+    base = os.path.dirname(rev.tex_path)
+    rev.tex = expand_includes(rev, rev.tex, base, git, {} if includes is None else includes, [rev.tex_path])
 
 
-def process_revision(oldnew):
-    '''Replaces references in revision and writes to temp file'''
+def expand_includes(rev, s, base, git, includes, parents):
+    '''Returns string with include commands replaced by the (expanded) contents of the included files. The files
+    included in the string are read at once. parents are the paths of the including files.'''
 
-    log.info('processing %s revision', oldnew)
+    matches = [m for m in include_re.finditer(s) if m.group(1)]
+    if not matches:
+        return s
+    paths = [include_path(base, m.group(2)) for m in matches]
+    contents = read_includes(rev, paths, git, includes)
+
+    segments = []
+    pos = 0
+    for match, path, text in zip(matches, paths, contents):
+        command = match.group(1)
+        if text is None:
+            log.warning('included file %s not found, leaving \\%s{%s} as is', path, command, match.group(2))
+            continue
+        if path in parents:
+            raise ValueError('circular include: {}'.format(' -> '.join(parents + [path])))
+        log.debug('including %s', path)
+        rev.stats.count('included_files')
+
+        # a subfile is a complete document, of which only the body is included
+        if command == 'subfile':
+            body = re.search(r'\\begin\s*{document}(.*)\\end\s*{document}', text, flags=re.S)
+            text = body.group(1) if body else text
+        text = expand_includes(rev, text, base, git, includes, parents + [path])
+        if text.endswith('\n'):
+            text = text[:-1]
+        if command == 'include':
+            text = '\\clearpage\n' + text + '\n\\clearpage'
+
+        segments.append(s[pos:match.start()])
+        segments.append(text)
+        pos = match.end()
+
+    segments.append(s[pos:])
+    return ''.join(segments)
+
+
+def include_path(base, name):
+    '''Returns path of a file included with \\input, \\include or \\subfile in a tex file in directory base'''
+
+    name = name.strip()
+    if not os.path.splitext(name)[1]:
+        name += '.tex'
+    return os.path.normpath(os.path.join(base, name))
+
+
+def read_includes(rev, paths, git, includes):
+    '''Returns list of contents of included files of a revision (None for files that do not exist). Files are looked
+    up in includes (dict), and the others are read concurrently from disk, or with a single request from git.'''
+
+    if rev.git_rev is None:
+        # files on disk are identified by path, size and modification time
+        keys = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                keys.append((os.path.abspath(path), st.st_size, st.st_mtime))
+            except OSError:
+                keys.append(None)
+        todo = collections.OrderedDict((key, path) for key, path in zip(keys, paths) if key and key not in includes)
+        if todo:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(todo), 8)) as executor:
+                texts = list(executor.map(lambda path: read_source(rev, path)[1], todo.values()))
+            includes.update(zip(todo, texts))
+        return [includes[key] if key else None for key in keys]
+
+    # files in git are identified by revision and path, and files with the same git object id share the contents
+    keys = [(rev.git_rev, path) for path in paths]
+    todo = [key[1] for key in collections.OrderedDict.fromkeys(keys) if key not in includes]
+    if todo:
+        bytes_read = git.bytes_read
+        with rev.stats.timer('git_extract'):
+            results = git.read_many(todo, rev.git_rev, rev.config.git_force_unix_pathsep, missing_ok=True)
+        rev.stats.count('bytes_read', git.bytes_read - bytes_read)
+        for path, (oid, contents) in zip(todo, results):
+            if oid is not None and oid not in includes:
+                includes[oid] = contents.decode(rev.config.encoding).replace('\r\n', '\n')
+            includes[rev.git_rev, path] = includes.get(oid)
+            rev.include_oids.append(oid)
+    return [includes[key] for key in keys]
+
+
+def process_revision(rev, bib_cache=None, bib_files=None, bib_tables=None):
+    '''Replaces references in revision, looking up parsed bib entries in bib_cache and bib_files, and author/year
+    resolved by another revision in bib_tables (if given)'''
+
+    log.info('processing %s revision', rev.name)
 
     # get references
-    log.debug('getting all reference keys from cite commands in %s revision', oldnew)
-    get_all_ref_keys(oldnew)
+    log.debug('getting all reference keys from cite commands in %s revision', rev.name)
+    with rev.stats.timer('citations'):
+        get_all_ref_keys(rev)
+    rev.stats.count('citations', len(rev.citations))
+    rev.stats.count('unique_keys', len(rev.refkeys))
 
     # get author-year strings and regex capture groups, either from bib file or bbl file
-    if getattr(FileContents, 'bbl_' + oldnew):
+    if rev.bbl:
         # get regex capture groups and make author-year strings from bbl files
         log.debug('retrieving regex matches from bbl')
-        get_capture_groups_from_bbl(oldnew)
-        make_author_year_tokens_from_bbl(oldnew)
+        with rev.stats.timer('bbl'):
+            get_capture_groups_from_bbl(rev)
+            make_author_year_tokens_from_bbl(rev)
     else:
         # make empty capture group dict
-        get_capture_groups_from_bbl(oldnew)
-        # make formatted author/year references unless %AUTHOR% and %YEAR% is not present in any formatting
-        if any('%AUTHOR%' in fmt['author'] or '%YEAR%' in fmt['year'] for fmt in Config.cmd_format.values()):
-            log.debug('creating author/year strings based on bib entries')
-            read_bibfile(oldnew)
-        else:
-            log.debug('%AUTHOR% and %YEAR% tokens not used in format, skipping parsing of bib entries')
-        make_author_year_tokens_from_bib(oldnew)
+        get_capture_groups_from_bbl(rev)
+        # make formatted author/year references from the bib files (read with the revision)
+        with rev.stats.timer('bib'):
+            make_author_year_tokens_from_bib(rev, bib_cache, bib_files, bib_tables)
 
     # replace citations with written-out references
-    log.debug('formatting and replacing references in %s revision', oldnew)
-    replace_refs_in_tex(oldnew)
-
-    # write contents to temp file
-    log.debug('writing %s changes to temp file', oldnew)
-    write_tex_to_temp(oldnew)
+    log.debug('formatting and replacing references in %s revision', rev.name)
+    with rev.stats.timer('replace'):
+        replace_refs_in_tex(rev)
 
 
-def get_all_ref_keys(oldnew):
-    '''Returns list of all unique reference keys in a revision, in order of appearance'''
+def get_all_ref_keys(rev):
+    '''Finds all citation commands in a revision, and makes the reference table of all unique reference keys in
+    order of appearance, numbered from 1 (the number used for %NUMERIC%)'''
 
-    refkeys = []
-    s = getattr(FileContents, 'tex_' + oldnew)
+    refkeys = collections.OrderedDict()
 
-    # find arguments of all LaTeX citation commands in document
-    all_cite_commands = '|'.join(Config.cmd_format.keys())
-    args_all_commands = re.findall(r'\\(?:' + all_cite_commands + r')\s*(?:\[[^\]]*?\]\s*){0,2}\{(.*?)\}', remove_comments(s), flags=re.S)
+    # find all LaTeX citation commands in document (a single pass, reused when replacing the commands)
+    citations = scan_citations(rev.tex, rev.config.cmd_format)
 
     # for each citation command, save new references
-    for args in args_all_commands:
-        ref_list = re.split('\s*,\s*', args)
+    for citation in citations:
+        ref_list = citation.keys
         log.debug('references found: %s', ref_list)
-        new_refs = [r for r in ref_list if r not in refkeys]
-        log.debug('new references: %s', new_refs)
-        refkeys.extend(new_refs)
+        for ref in ref_list:
+            if ref not in refkeys:
+                log.debug('new reference: %s', ref)
+                refkeys[ref] = len(refkeys) + 1
+
+    rev.citations = citations
+    rev.refkeys = refkeys
+
+
+def scan_citations(s, cmd_format):
+    '''Returns list of all LaTeX citation commands in a string as Citation records, in order of appearance.
+
+    The string is scanned once. Commented-out parts of lines are skipped, and the spans of the records refer
+    to positions in the original string.'''
 
-    setattr(References, 'refkeys_' + oldnew, refkeys)
+    # match either a comment (which is skipped) or any of the configured citation commands with up to two
+    # optional arguments; longest command names first so that e.g. citep is not shadowed by cite. Comments in the
+    # reference keys are skipped, so that a } in a comment does not end the command
+    all_cite_commands = '|'.join(re.escape(cmd) for cmd in sorted(cmd_format, key=len, reverse=True))
+    p = re.compile(r'%[^\n]*|\\(' + all_cite_commands + r')\s*(?:\[([^\]]*?)\]\s*)?(?:\[([^\]]*?)\]\s*)?'
+                   r'\{((?:%[^\n]*|[^%}])*)\}')
+
+    citations = []
+    for match in p.finditer(s):
+        cite_cmd, arg1, arg2, cite_args = match.groups()
+        if cite_cmd is None:
+            # comment
+            continue
+
+        # a single optional argument is the postnote
+        if arg2 is None:
+            prenote, postnote = None, arg1
+        else:
+            prenote, postnote = arg1, arg2
+
+        keys = re.split(r'\s*,\s*', remove_comments(cite_args))
+        citations.append(Citation(match.start(), match.end(), cite_cmd, prenote, postnote, keys))
+
+    return citations
 
 
 def remove_comments(s):
@@ -415,49 +1637,104 @@ def remove_comments(s):
     return s
 
 
-def get_capture_groups_from_bbl(oldnew):
+def get_capture_groups_from_bbl(rev):
     '''Fetches capture groups from bbl_contents for all refs'''
 
-    refkeys = getattr(References, 'refkeys_' + oldnew)
-    bbl_contents = getattr(FileContents, 'bbl_' + oldnew)
+    refkeys = rev.refkeys
+    bbl_contents = rev.bbl
 
     # create empty dict if bbl_contents is empty
     if not bbl_contents:
-        setattr(References, 'capture_groups_' + oldnew,
-                dict(zip(getattr(References, 'refkeys_' + oldnew), [tuple()]*len(refkeys))))
+        rev.capture_groups = dict(zip(refkeys, [tuple()]*len(refkeys)))
         return
 
     capture_groups = {}
 
+    # split the bbl file into \bibitem blocks once, and compile the regex once (the reference key is known
+    # from the block, so %REFKEY% only has to match any key)
+    bbl_index = index_bbl_items(bbl_contents)
+    exp = rev.config.bbl['regex'].replace('%REFKEY%', r'(?:[^{}]*?)')
+    log.debug('looking for refs in bibitems with regex %s', exp)
+    p = re.compile(exp, re.S | re.M)
+
     # process each reference individually
     for ref in refkeys:
 
-        # crap out if the reference isn't found in the bbl file
-        if ref not in bbl_contents:
-            raise ValueError('Reference \'' + ref + '\' not present in bbl file')
+        if ref in bbl_index:
+            start, end = bbl_index[ref]
+            match = p.search(bbl_contents, start, end)
+        else:
+            # not a \bibitem (e.g. a custom bbl format), so fall back to searching the whole bbl file
+
+            # crap out if the reference isn't found in the bbl file
+            if ref not in bbl_contents:
+                raise ValueError('Reference \'' + ref + '\' not present in bbl file')
 
-        # regex pattern to look for the correct entry
-        exp = Config.bbl['regex'].replace('%REFKEY%', ref)
-        log.debug('looking for ref %s with regex %s', ref, exp)
-        p = re.compile(exp, re.S | re.M)
+            # regex pattern to look for the correct entry
+            exp = rev.config.bbl['regex'].replace('%REFKEY%', re.escape(ref))
+            log.debug('looking for ref %s with regex %s', ref, exp)
+            match = re.search(exp, bbl_contents, re.S | re.M)
 
-        # search using the regex, crap out if nothing was matched
-        match = re.search(p, bbl_contents)
+        # crap out if nothing was matched
         if match is None:
-            raise ValueError('No match in bbl file for reference ' + ref + ' using regex ' + exp)
+            raise ValueError('No match in bbl file for reference ' + ref + ' using regex ' + rev.config.bbl['regex'])
 
         # add captured groups to dict
         capture_groups[ref] = match.groups()
 
         log.debug('capture tokens from refkey %s: %s', ref, match.groups())
 
-    setattr(References, 'capture_groups_' + oldnew, capture_groups)
+    rev.capture_groups = capture_groups
+
+
+def index_bbl_items(bbl_contents):
+    '''Scans the contents of a bbl file once and returns a dict with reference keys as keys and the (start, end)
+    span of the corresponding \\bibitem block (up to the next \\bibitem) as values'''
+
+    starts = [m.start() for m in re.finditer(r'\\bibitem\b', bbl_contents)]
+    index = {}
+    for start, end in zip(starts, starts[1:] + [len(bbl_contents)]):
+        key = parse_bibitem_key(bbl_contents, start + len('\\bibitem'), end)
+        if key is not None:
+            index.setdefault(key, (start, end))
+    log.debug('indexed %d bibitems', len(index))
+    return index
+
+
+def parse_bibitem_key(s, pos, end):
+    '''Returns the reference key of a \\bibitem[label]{key} command, where pos is the position right after
+    \\bibitem, or None if no key is found before end. Braces in the label may be nested.'''
+
+    whitespace = re.compile(r'\s*')
+    pos = whitespace.match(s, pos, end).end()
+
+    # skip the optional label, where ] only counts outside of braces
+    if s.startswith('[', pos):
+        depth = 0
+        for pos in range(pos + 1, end):
+            c = s[pos]
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+            elif c == ']' and depth == 0:
+                break
+        else:
+            return None
+        pos = whitespace.match(s, pos + 1, end).end()
+
+    if not s.startswith('{', pos):
+        return None
+    close = s.find('}', pos, end)
+    if close == -1:
+        return None
+    return s[pos + 1:close].strip()
 
 
-def make_author_year_tokens_from_bbl(oldnew):
+def make_author_year_tokens_from_bbl(rev):
     '''Fetches the formatted author name and year from bbl_contents'''
 
-    refkeys = getattr(References, 'refkeys_' + oldnew)
+    refkeys = rev.refkeys
 
     # keys = reference key, values = tuple of (%AUTHOR%, %YEAR%)
     authyear = {}
@@ -466,42 +1743,67 @@ def make_author_year_tokens_from_bbl(oldnew):
     for ref in refkeys:
 
         # get author string from config, replace capture group tokens
-        name = Config.bbl['author']
-        name = replace_capture_groups(name, ref, oldnew)
+        name = rev.config.bbl['author']
+        name = replace_capture_groups(name, ref, rev)
 
         # get year string from config, replace capture group tokens
-        year = Config.bbl['year']
-        year = replace_capture_groups(year, ref, oldnew)
+        year = rev.config.bbl['year']
+        year = replace_capture_groups(year, ref, rev)
 
         # append the name and the year to the list
         authyear[ref] = (name, year)
 
         log.debug('formatted tokens (%%AUTHOR%%, %%YEAR%%) for %s as %s', ref, (name, year))
 
-    setattr(References, 'authyear_' + oldnew, authyear)
+    rev.authyear = authyear
 
 
-def replace_capture_groups(s, ref, oldnew):
+def replace_capture_groups(s, ref, rev):
     '''Replaces all capture group tokens in string'''
 
-    for i, replacement in enumerate(getattr(References, 'capture_groups_' + oldnew)[ref]):
+    for i, replacement in enumerate(rev.capture_groups[ref]):
         s = s.replace('%CG{}%'.format(i+1), replacement or '')
     return s
 
 
-def read_bibfile(oldnew):
-    '''Reads contents of bibtex files'''
+def uses_author_year(config):
+    '''Returns True if %AUTHOR% or %YEAR% is present in the formatting of any citation command'''
+
+    return any('%AUTHOR%' in fmt['author'] or '%YEAR%' in fmt['year'] for fmt in config.cmd_format.values())
+
+
+def read_bibfile(rev, git=None, includes=None):
+    '''Reads contents of bibtex files, from the git revision through git (a GitCatFile) if reading from git. Files on
+    disk are looked up in includes (dict) before reading them, if given, so that files used by both revisions are read
+    once.'''
 
     # get bibtex file
-    bibarg = find_bibliography_arg(getattr(FileContents, 'tex_' + oldnew))
-    find_bibfiles(bibarg, oldnew)
-    bibfiles = getattr(Files, 'bib_' + oldnew + '_path')
+    bibarg = find_bibliography_arg(rev.tex)
+    find_bibfiles(bibarg, rev)
+    bibfiles = rev.bib_paths
+
+    # bib files on disk are read when looking up the references if streaming or memory-mapping them
+    if get_bib_reader(rev) != 'read':
+        log.debug('bibtex files will be read with bib_reader %s', rev.config.bib_reader)
+        return
 
     # read bibtex files
     for bibfile in bibfiles:
-        log.debug('reading bibtex file %s', bibfile)
-        with io.open(bibfile, 'r', encoding=Config.encoding) as f:
-            getattr(FileContents, 'bib_' + oldnew).append(f.read())
+        if rev.git_rev is None and includes is not None:
+            # files on disk are identified by path, size and modification time, like included files
+            st = os.stat(bibfile)
+            key = (os.path.abspath(bibfile), st.st_size, st.st_mtime)
+            if key in includes:
+                log.debug('bibtex file %s already read', bibfile)
+            else:
+                log.debug('reading bibtex file %s', bibfile)
+                includes[key] = read_source(rev, bibfile, git)[1]
+            oid, contents = None, includes[key]
+        else:
+            log.debug('reading bibtex file %s', bibfile)
+            oid, contents = read_source(rev, bibfile, git)
+        rev.bib.append(contents)
+        rev.bib_oids.append(oid)
 
 
 def find_bibliography_arg(s):
@@ -513,10 +1815,13 @@ def find_bibliography_arg(s):
     return bibfile
 
 
-def find_bibfiles(arg, oldnew):
+def find_bibfiles(arg, rev):
     '''Searches for the bibfiles on the system'''
 
-    sourcepath = os.path.dirname(getattr(Files, 'tex_' + oldnew + '_path'))
+    sourcepath = os.path.dirname(rev.tex_path)
+    if rev.git_rev is not None:
+        log.debug('looking for bibtex files in git revision %s', rev.git_rev)
+        sourcepath = os.path.normpath(sourcepath) if sourcepath else ''
     fnames = re.split('\s*,\s*', arg)
     for i, fname in enumerate(fnames):
         fnames[i] = fname if fname.endswith('.bib') else fname + '.bib'
@@ -525,140 +1830,292 @@ def find_bibfiles(arg, oldnew):
     for fname in fnames:
         log.debug('looking for bibtex file "%s" in %s', fname, sourcepath)
         bibpath = os.path.join(sourcepath, fname)
+        if rev.git_rev is not None:
+            # git does not resolve .. in paths, and a missing file is reported by git when reading it
+            rev.bib_paths.append(os.path.normpath(bibpath))
+            continue
         if not os.path.exists(bibpath):
             raise IOError('bibtex file not found with or without .bib extension: {} ({})'
                           .format(bibpath, os.path.abspath(bibpath)))
 
         log.debug('found bibtex file %s', os.path.abspath(bibpath))
-        getattr(Files, 'bib_' + oldnew + '_path').append(bibpath)
+        rev.bib_paths.append(bibpath)
 
 
-def make_author_year_tokens_from_bib(oldnew):
-    '''Looks up reference keys in bib_contents and figures out what the written-out author name and year should be'''
+def make_author_year_tokens_from_bib(rev, bib_cache=None, bib_files=None, bib_tables=None):
+    '''Looks up reference keys in bib_contents and figures out what the written-out author name and year should be.
+    If bib_tables (dict) is given, the author/year of references already resolved from the same bib files (e.g. by
+    the other revision) are reused.'''
 
-    refkeys = getattr(References, 'refkeys_' + oldnew)
+    refkeys = rev.refkeys
 
     # if numeric mode (%AUTHOR% and %YEAR% not used in any fields), return empty strings
-    if all('%AUTHOR%' not in fmt['author'] and '%YEAR%' not in fmt['year'] for fmt in Config.cmd_format.values()):
+    if not uses_author_year(rev.config):
         log.debug('no %AUTHOR% or %YEAR% tokens detected in any fields, skipping formatting of author/year')
         authyear = dict(zip(refkeys, [('', '')]*len(refkeys)))
-        setattr(References, 'authyear_' + oldnew, authyear)
+        rev.authyear = authyear
         return
 
     # keys = reference key, values = tuple of (%AUTHOR%, %YEAR%)
     authyear = {}
-    
-    # find author list in entry and create author string
-    author_re = [re.compile(r'author\s*=\s*[{"]((?:[^{}]+?|{[^}]+?})+?)[}"]', re.I | re.M | re.S),
-                re.compile(r'editor\s*=\s*[{"]((?:[^{}]+?|{[^}]+?})+?)[}"]', re.I | re.M | re.S),
-                re.compile(r'howpublished\s*=\s*[{"]((?:[^{}]+?|{[^}]+?})+?)[}"]', re.I | re.M | re.S),
-            ]
 
+    # bib files are indexed once (or not at all if all cited entries are cached), entries are only parsed when cited
+    # bib files read from git are identified by their git object id (and the encoding used to decode them), others
+    # by the hash of their contents
+    if get_bib_reader(rev) != 'read':
+        bib_ids = [bibfile_on_disk_key(path, rev.config) for path in rev.bib_paths]
+        bibfiles = [get_bibfile_on_disk(path, rev.config, bib_cache, bib_files) for path in rev.bib_paths]
+    else:
+        oids = rev.bib_oids or [None]*len(rev.bib)
+        bibfiles = [get_bibfile(contents, bib_cache, bib_files, oid and '{}:{}'.format(oid, rev.config.encoding))
+                    for contents, oid in zip(rev.bib, oids)]
+        bib_ids = [bibfile.digest for bibfile in bibfiles]
+    # for the stats: entries scanned and parsed before (e.g. by the other revision)
+    n_parsed = sum(bibfile.n_parsed for bibfile in bibfiles)
+    n_scanned = sum(bibfile.n_scanned for bibfile in bibfiles)
+
+    # author/year of the references resolved from the same bib files with the same settings, before the duplicate
+    # authors of this revision are corrected
+    table = {}
+    if bib_tables is not None:
+        table = bib_tables.setdefault((tuple(bib_ids), tuple(sorted(rev.config.bib.items()))), {})
+    shared = [ref for ref in refkeys if ref in table]
+    authyear.update((ref, table[ref]) for ref in shared)
+    if shared:
+        log.debug('%d references already resolved from the same bibtex files', len(shared))
+
+    # look up the references not found yet in each bib file in turn (the first file with a reference wins), and
+    # stop when all are found, so that the remaining files are not read or indexed
+    outstanding = [ref for ref in refkeys if ref not in table]
+    bib_names = rev.bib_paths or ['#{}'.format(i + 1) for i in range(len(bibfiles))]
+    for i, bibfile in enumerate(bibfiles):
+
+        if not outstanding:
+            log.debug('all references found, skipping bibtex files %s', ', '.join(bib_names[i:]))
+            break
 
-    # find year in entry and create year string
-    year_re = re.compile(r'\s*year\s*=\s*["{]?\s*(\d+)\s*["}]?', flags=re.IGNORECASE)
+        found = bibfile.lookup_many(outstanding)
+        log.debug('%d of %d references found in bibtex file %s', len(found), len(outstanding), bib_names[i])
 
-    # process each reference individually
-    for ref in refkeys:
+        for ref, (surnames, year) in found.items():
 
-        ref_found = False
+            # use "first author et al." if author list is too long
+            if len(surnames) > rev.config.bib['max_authors']:
+                name = surnames[0] + rev.config.bib['et_al']
+            else:
+                name = format_authorlist(surnames, rev.config)
 
-        # check each bib file
-        for i, bib_contents in enumerate(getattr(FileContents, 'bib_' + oldnew)):
+            # append the name and the year to the list
+            authyear[ref] = table[ref] = (name, year)
+            log.debug('formatted tokens (%%AUTHOR%%, %%YEAR%%) for %s as %s', ref, (name, year))
 
-            if ref not in bib_contents:
-                log.info('Reference not found in bib file %s', ref)
-                continue
+        outstanding = [ref for ref in outstanding if ref not in found]
 
-            log.debug('formatting %s', ref)
+    # bib files that are not kept are closed here
+    if bib_files is None:
+        for bibfile in bibfiles:
+            bibfile.close()
 
-            # regex pattern to look for a whole entry - based on tips from the interwebs
-            p = re.compile(r'^\s*@\s*\w+\s*\{\s*' + ref + r'\s*,.*?^\}', re.S | re.M)
-            entries = re.findall(p, bib_contents)
-            
-            if len(entries) == 0:
-                log.info('Reference not found in bib file %s', ref)
-                continue
-            
-            entry = entries[0]
-
-            # AUTHOR
-
-            # split into a list of all authors
-            # print("entry: ",entry)
-            # print("re search: ",author_re.search(entry))
-            authors = ""
-            for author_type in author_re:
-                author_search = author_type.search(entry)
-                if author_search is not None:
-                    authors = re.split('\s+and\s+', author_search.group(1))
-                    break
-            if authors == "":
-                raise NameError(f"Failed to find author/editor/etc information for {entry}")
+    # crap out if a reference isn't found in any bib file
+    if outstanding:
+        raise ValueError('Reference \'' + outstanding[0] + '\' not found in any bibtex file')
 
-            # get a list of only the surnames
-            if any(',' in a for a in authors):
-                # the name of each author is comma separated
-                surnames = [a.split(',')[0] for a in authors]
-            else:
-                # split on space and assume the last word in each name is the surname
-                surnames = [a.split(' ')[-1] for a in authors]
+    rev.authyear = authyear
+    rev.stats.count('bib_entries_parsed', sum(bibfile.n_parsed for bibfile in bibfiles) - n_parsed)
+    rev.stats.count('bib_entries_scanned', sum(bibfile.n_scanned for bibfile in bibfiles) - n_scanned)
+    rev.stats.count('bib_references_shared', len(shared))
 
-            # remove any curly braces and spaces from surnames
-            surnames = [re.sub('[{}]', '', s.strip()) for s in surnames]
+    correct_duplicate_authors(rev)
 
-            # use "first author et al." if author list is too long
-            if len(surnames) > Config.bib['max_authors']:
-                name = surnames[0] + Config.bib['et_al']
-            else:
-                name = format_authorlist(surnames)
 
-            # YEAR
+def get_bibfile(contents, bib_cache=None, bib_files=None, digest=None):
+    '''Returns BibFile for the contents of a bib file, identified by digest (default: hash of the contents). If
+    bib_files (dict of digest -> BibFile) is given, a BibFile with the same digest is reused, so that the file is
+    only indexed and parsed once.'''
 
-            # find year in entry and create year string
-            try:
-                year = year_re.search(entry).group(1)
-            except:
-                raise NameError(f"Failed to find year info for {entry}")
+    digest = digest or BibFile.hash(contents)
+    if bib_files is None:
+        return BibFile(contents, bib_cache, digest)
+    if digest not in bib_files:
+        bib_files[digest] = BibFile(contents, bib_cache, digest)
+    return bib_files[digest]
 
-            # append the name and the year to the list
-            authyear[ref] = (name, year)
 
-            ref_found = True
+def get_bib_reader(rev):
+    '''Returns how the bib files of a revision are read: read (into memory), stream or mmap. Bib files from git are
+    always read into memory.'''
 
-            log.debug('reference %s found in bibtex file %s', ref, getattr(Files, 'bib_' + oldnew + '_path')[i])
-            log.debug('formatted tokens (%%AUTHOR%%, %%YEAR%%) for %s as %s', ref, (name, year))
+    if rev.config.bib_reader not in ['read', 'stream', 'mmap']:
+        raise ValueError('unknown bib_reader {!r}, must be read, stream or mmap'.format(rev.config.bib_reader))
+    return 'read' if rev.git_rev is not None else rev.config.bib_reader
+
+
+def get_bibfile_on_disk(path, config, bib_cache=None, bib_files=None):
+    '''Returns StreamedBibFile or MappedBibFile (according to config.bib_reader) for a bib file on disk. If bib_files
+    (dict) is given, the same object is reused for the same file (identified by path, size and modification time),
+    so that each entry is only looked up once.'''
+
+    key = None
+    if bib_files is not None:
+        key = bibfile_on_disk_key(path, config)
+        if key in bib_files:
+            return bib_files[key]
+
+    if config.bib_reader == 'stream':
+        bibfile = StreamedBibFile(path, config.encoding, bib_cache)
+    else:
+        index_dir = os.path.join(os.path.expanduser(config.cache_dir), 'bibindex') if config.cache_dir else None
+        bibfile = MappedBibFile(path, config.encoding, bib_cache, index_dir)
+    if key is not None:
+        bib_files[key] = bibfile
+    return bibfile
+
+
+def close_bib_files(bib_files):
+    '''Releases the resources (memory maps) held by the bib files in bib_files (dict). The files stay usable.'''
+
+    for bibfile in bib_files.values():
+        bibfile.close()
+
+
+def bibfile_on_disk_key(path, config):
+    '''Returns the key identifying a bib file on disk read with config.bib_reader: the reader, path, size, modification
+    time and encoding'''
+
+    st = os.stat(path)
+    return config.bib_reader, os.path.abspath(path), st.st_size, st.st_mtime, config.encoding
 
-            # no need to look in other bib files
+
+# start of a bib entry (type and key), and the closing brace of an entry at the start of a line
+bib_entry_start_re = re.compile(r'^\s*@\s*\w+\s*\{\s*([^\s,]+)\s*,', re.M)
+bib_entry_end_re = re.compile(r'^\}', re.M)
+# the start of a bib entry cut off before the comma after the key (e.g. when the key is on the next line)
+bib_entry_partial_start_re = re.compile(r'\s*@\s*(?:\w+\s*(?:\{\s*(?:[^\s,]+\s*)?)?)?\Z')
+bib_entry_start_bytes_re = re.compile(bib_entry_start_re.pattern.encode('ascii'), re.M)
+bib_entry_end_bytes_re = re.compile(bib_entry_end_re.pattern.encode('ascii'), re.M)
+
+# find author list in entry (falling back to editor and howpublished)
+bib_author_re = [re.compile(r'author\s*=\s*[{"]((?:[^{}]+?|{[^}]+?})+?)[}"]', re.I | re.M | re.S),
+                 re.compile(r'editor\s*=\s*[{"]((?:[^{}]+?|{[^}]+?})+?)[}"]', re.I | re.M | re.S),
+                 re.compile(r'howpublished\s*=\s*[{"]((?:[^{}]+?|{[^}]+?})+?)[}"]', re.I | re.M | re.S)]
+
+# find year in entry
+bib_year_re = re.compile(r'\s*year\s*=\s*["{]?\s*(\d+)\s*["}]?', flags=re.IGNORECASE)
+
+
+def index_bib_entries(bib_contents, encoding=None):
+    '''Scans the contents of a bib file once and returns a dict with reference keys as keys and the (start, end)
+    span of the corresponding entry as values (the first entry wins if a key occurs more than once). If encoding is
+    given, bib_contents are bytes (e.g. a memory-mapped file) in that encoding, and the spans are byte offsets.'''
+
+    if encoding:
+        start_re, end_re = bib_entry_start_bytes_re, bib_entry_end_bytes_re
+    else:
+        start_re, end_re = bib_entry_start_re, bib_entry_end_re
+    index = {}
+    for match in start_re.finditer(bib_contents):
+        end = end_re.search(bib_contents, match.end())
+        if end is None:
+            # unterminated entry at the end of the file
             break
+        refkey = match.group(1).decode(encoding) if encoding else match.group(1)
+        index.setdefault(refkey, (match.start(), end.end()))
+    log.debug('indexed %d bib entries', len(index))
+    return index
+
+
+def iter_bib_entries(lines, refkeys=None, callback=None):
+    '''Reads a bib file given as an iterable of lines (e.g. an open file), and yields tuple of (reference key, entry)
+    for each entry in the file, in order. If refkeys is given, the entry is None for other keys, and only the lines of
+    entries in refkeys are kept. callback (if given) is called with each line, encoded as UTF-8.'''
+
+    refkey = None
+    entry = None
+    # lines read since a possible start of an entry whose key has not been seen yet
+    pending = []
+    for line in lines:
+        if callback:
+            callback(line.encode('utf-8'))
+        if refkey is None:
+            if not pending and '@' not in line:
+                continue
+            pending.append(line)
+            while pending:
+                text = ''.join(pending)
+                match = bib_entry_start_re.match(text)
+                if match:
+                    refkey = match.group(1)
+                    entry = pending if refkeys is None or refkey in refkeys else None
+                    pending = []
+                elif not bib_entry_partial_start_re.match(text):
+                    # no entry starts at the first pending line, look for one starting at the next line
+                    del pending[0]
+                    continue
+                break
+        else:
+            if entry is not None:
+                entry.append(line)
+            if line.startswith('}'):
+                yield refkey, entry and ''.join(entry)
+                refkey = None
+                entry = None
 
-        # crap out if the reference isn't found in any bib file
-        if not ref_found:
-            raise ValueError('Reference \'' + ref + '\' not found in any bibtex file')
 
-    setattr(References, 'authyear_' + oldnew, authyear)
+def parse_bib_entry(entry):
+    '''Returns a tuple of (list of surnames, year) from a single bib entry'''
 
-    correct_duplicate_authors(oldnew)
+    # AUTHOR
 
+    # split into a list of all authors
+    authors = ""
+    for author_type in bib_author_re:
+        author_search = author_type.search(entry)
+        if author_search is not None:
+            authors = re.split(r'\s+and\s+', author_search.group(1))
+            break
+    if authors == "":
+        raise NameError(f"Failed to find author/editor/etc information for {entry}")
+
+    # get a list of only the surnames
+    if any(',' in a for a in authors):
+        # the name of each author is comma separated
+        surnames = [a.split(',')[0] for a in authors]
+    else:
+        # split on space and assume the last word in each name is the surname
+        surnames = [a.split(' ')[-1] for a in authors]
+
+    # remove any curly braces and spaces from surnames
+    surnames = [re.sub('[{}]', '', s.strip()) for s in surnames]
+
+    # YEAR
+
+    # find year in entry and create year string
+    try:
+        year = bib_year_re.search(entry).group(1)
+    except:
+        raise NameError(f"Failed to find year info for {entry}")
 
-def format_authorlist(surnames):
+    return surnames, year
+
+
+def format_authorlist(surnames, config):
     '''Given a list of surnames, formats a string of all surnames correctly'''
 
     n = len(surnames)
-    serialcomma = ','*(n > 2 and Config.bib['author_serialcomma'])  # serial comma if at least 3 names
-    return (('{}' + Config.bib['sep_authors_first'])*(n-2) +  # name + first-kind separator if names > 2
-            ('{}' + serialcomma + Config.bib['sep_authors_last'])*(n > 1) +   # penultimate name and last-kind separator
+    serialcomma = ','*(n > 2 and config.bib['author_serialcomma'])  # serial comma if at least 3 names
+    return (('{}' + config.bib['sep_authors_first'])*(n-2) +  # name + first-kind separator if names > 2
+            ('{}' + serialcomma + config.bib['sep_authors_last'])*(n > 1) +   # penultimate name and last-kind separator
             '{}').format(*surnames)  # final (or only) author name
 
 
-def correct_duplicate_authors(oldnew):
+def correct_duplicate_authors(rev):
     '''If the same author string exists for multiple references, appends a letter to the corresponding years,
     e.g. Foo and Bar, 2012a, 2012b (letters will be appended in the order of appearance)'''
 
     log.debug('looking through author/year for duplicates and appending letter to year')
 
-    authyear = getattr(References, 'authyear_' + oldnew)
-    refkeys = getattr(References, 'refkeys_' + oldnew)
+    authyear = rev.authyear
+    refkeys = rev.refkeys
 
     # key = all formatted author/year tuples, values = refkeys where exactly this combo occurs
     occurrences = {}
@@ -687,58 +2144,109 @@ def correct_duplicate_authors(oldnew):
                 authyear[refkey] = (tup[0], year)
 
 
-def replace_refs_in_tex(oldnew):
+def replace_refs_in_tex(rev):
     '''The workhorse for replacing LaTeX citation commands with formatted references.
 
     Searches for citation commands in the tex file contents, calls format_refs() to get the written-out
     citations for each citation command, and replaces the citation command with the written-out citations.'''
 
-    s = getattr(FileContents, 'tex_' + oldnew)
-
-    # find all LaTeX citation commands in the string (exclude commented-out commands)
-    matches = re.findall(r'(\\(cite[tp]?)\s*((?:\[[^\]]*?\]\s*){0,2})\{(.*?)\})', remove_comments(s), flags=re.S) + re.findall(r'(\\(citenum)\s*((?:\[[^\]]*?\]\s*){0,2})\{(.*?)\})', remove_comments(s), flags=re.S)
-
-    # process the references for each citation command
-    for full_cmd, cite_cmd, opt_args, cite_args in matches:
+    s = rev.tex
 
-        log.debug('replacing %s', full_cmd)
+    # citation commands found by get_all_ref_keys() (comments already excluded)
+    citations = rev.citations
 
-        # split args to get a list of reference keys
-        refs_this = re.split('\s*,\s*', cite_args)
+    # build the output from the text between citation commands and the written-out references
+    segments = []
+    pos = 0
+    for citation in citations:
 
-        # find prenote/postnote if present
-        arg1, arg2 = re.search('(?:\[(.*?)\])?\s*(?:\[(.*?)\])?', opt_args).groups()
-        if arg2 is None:
-            prenote = None
-            postnote = arg1
-        else:
-            prenote = arg1
-            postnote = arg2
+        log.debug('replacing %s', s[citation.start:citation.end])
 
         # pass the list of references in this command to format_refs() to get the written-out references
-        formatted = format_refs(oldnew, refs_this, cite_cmd, prenote, postnote)
+        formatted = format_refs(rev, list(citation.keys), citation.command, citation.prenote, citation.postnote)
 
         # replace the entire cite command with the written-out references
-        s = s.replace(full_cmd, formatted)
+        segments.append(s[pos:citation.start])
+        segments.append(formatted)
+        pos = citation.end
+
+    segments.append(s[pos:])
+    s = ''.join(segments)
 
     # add \nocite{} before end{document} so that reference list will be written
-    nocite = r'\\nocite{' + ','.join(getattr(References, 'refkeys_' + oldnew)) + '}'
+    nocite = r'\\nocite{' + ','.join(rev.refkeys) + '}'
     log.debug('adding \\nocite before \\end{document}: %s', nocite)
     s = re.sub(r'(^[^%\n]*?\\end\s*{document})', nocite + r'\n\1', s, flags=re.M)
 
     # add custom reference protection command to preamble
-    if Config.ref_single_word:
+    if rev.config.ref_single_word:
         log.debug('adding declaration of citation protection command before \\begin{document}: \\newcommand{\\ldiffentity}[1]{#1}')
         s = re.sub(r'(^[^%\n]*?\\begin\s*{document})', r'\\newcommand{\\ldiffentity}[1]{#1}\n\1', s, flags=re.M)
 
-    setattr(FileContents, 'tex_' + oldnew, s)
+    rev.tex = s
+
 
+# tokens in the author and year templates of the citation commands (capture groups are numbered from 1)
+template_token_re = re.compile(r'%(AUTHOR|YEAR|NUMERIC|CG([1-9][0-9]*))%')
+
+# compiled templates, dict of (template, tokens) -> segments
+compiled_templates = {}
+
+# maximum number of formatted citation commands remembered for each revision
+format_refs_memo_size = 10000
+
+
+def compile_template(template, tokens):
+    '''Returns a template split into a list of (token, value) segments, where token is None for literal text (the
+    value), 'CG' for a capture group (the value is its 0-based index), or one of tokens (e.g. 'AUTHOR') to be
+    replaced. Other tokens are kept as literal text. Each template is only split once.'''
+
+    try:
+        return compiled_templates[template, tokens]
+    except KeyError:
+        pass
+
+    segments = []
+    pos = 0
+    for m in template_token_re.finditer(template):
+        if m.group(2):
+            token, value = 'CG', int(m.group(2)) - 1
+        elif m.group(1) in tokens:
+            token, value = m.group(1), None
+        else:
+            continue
+        if m.start() > pos:
+            segments.append((None, template[pos:m.start()]))
+        segments.append((token, value))
+        pos = m.end()
+    if pos < len(template):
+        segments.append((None, template[pos:]))
+
+    compiled_templates[template, tokens] = segments
+    return segments
+
+
+def render_template(segments, capture_groups, values):
+    '''Returns a compiled template with capture groups and tokens replaced by their values (dict of token ->
+    string). Capture groups that are not in capture_groups are kept as they are.'''
+
+    out = []
+    for token, value in segments:
+        if token is None:
+            out.append(value)
+        elif token == 'CG':
+            out.append((capture_groups[value] or '') if value < len(capture_groups) else '%CG{}%'.format(value+1))
+        else:
+            out.append(values[token])
+    return ''.join(out)
 
-def format_refs(oldnew, replace_refs, cite_cmd, prenote, postnote):
+
+def format_refs(rev, replace_refs, cite_cmd, prenote, postnote):
     '''The workhorse for creating written-out formatted references corresponding to a given citation command
-    and reference list'''
+    and reference list. The result is remembered for each revision, so repeated citation commands are only
+    formatted once.'''
 
-    authyear = getattr(References, 'authyear_' + oldnew)
+    authyear = rev.authyear
 
     # prenotes/postnotes are not implemented for citet, so show a warning if that happens
     if (prenote or postnote) and cite_cmd == 'citet':
@@ -746,8 +2254,18 @@ def format_refs(oldnew, replace_refs, cite_cmd, prenote, postnote):
         prenote = None
         postnote = None
 
-    # shortcut to formatting data for this specific cite command
-    fmt = Config.cmd_format[cite_cmd]
+    # return the remembered result if this citation command has been formatted before
+    memo_key = (cite_cmd, tuple(replace_refs), prenote, postnote)
+    out = rev.formatted_refs.get(memo_key)
+    if out is not None:
+        log.debug('result (formatted before): %s', out)
+        rev.stats.count('citations_memoized')
+        return out
+
+    # shortcut to formatting data for this specific cite command, with the author and year templates compiled
+    fmt = rev.config.cmd_format[cite_cmd]
+    author_template = compile_template(fmt['author'], ('AUTHOR', 'NUMERIC'))
+    year_template = compile_template(fmt['year'], ('YEAR',))
 
     # start building the formatted string
     out = fmt['cite_start']
@@ -757,8 +2275,8 @@ def format_refs(oldnew, replace_refs, cite_cmd, prenote, postnote):
         out += prenote + fmt['sep_prenote']
 
     # start and end of citation protection command
-    ldiffstart = '\\ldiffentity{' if Config.ref_single_word else ''
-    ldiffend = '}' if Config.ref_single_word else ''
+    ldiffstart = '\\ldiffentity{' if rev.config.ref_single_word else ''
+    ldiffend = '}' if rev.config.ref_single_word else ''
 
     # we're going to process each reference by popping them out of the list
     # and looping while there's still something in the list
@@ -777,19 +2295,15 @@ def format_refs(oldnew, replace_refs, cite_cmd, prenote, postnote):
 
         # AUTHOR
         # replace capture groups, %AUTHOR% token and %NUMERIC% token
-        author = fmt['author']
-        author = replace_capture_groups(author, ref, oldnew)
-        author = author.replace('%AUTHOR%', authyear[ref][0])
-        author = author.replace('%NUMERIC%', str(getattr(References, 'refkeys_' + oldnew).index(ref)+1))
-        out += author
+        out += render_template(author_template, rev.capture_groups[ref],
+                               {'AUTHOR': authyear[ref][0], 'NUMERIC': str(rev.refkeys[ref])})
 
         # author-year separator
         out += fmt['sep_author_year']
 
         # YEAR
-        # replace capture groups
-        year = fmt['year']
-        year = replace_capture_groups(year, ref, oldnew)
+        # the capture groups are those of the first reference of the year string
+        year_capture_groups = rev.capture_groups[ref]
 
         # To replace the %YEAR% token, a bit more work is required since the year string can consist of
         # multiple years if the author string is the same for consecutive references.
@@ -812,8 +2326,8 @@ def format_refs(oldnew, replace_refs, cite_cmd, prenote, postnote):
 
             ref = ref2
 
-        # replace %YEAR% token by the string we made above and append to output
-        out += year.replace('%YEAR%', year_token)
+        # replace capture groups and %YEAR% token by the string we made above and append to output
+        out += render_template(year_template, year_capture_groups, {'YEAR': year_token})
 
         # add the end bracket for reference diff protection
         if ldiff_author:
@@ -832,29 +2346,240 @@ def format_refs(oldnew, replace_refs, cite_cmd, prenote, postnote):
 
     log.debug('result: %s', out)
 
+    # remember the result, forgetting the oldest one if there are too many
+    if len(rev.formatted_refs) >= format_refs_memo_size:
+        rev.formatted_refs.popitem(last=False)
+    rev.formatted_refs[memo_key] = out
+
     return out
 
 
-def write_tex_to_temp(oldnew):
-    '''Writes processed file contents to temp files'''
+def write_tex_to_temp(job, name):
+    '''Writes processed file contents of the old or new revision (name) to its temp file'''
 
-    log.debug('writing to file %s', getattr(Files, 'tex_' + oldnew + '_tmp_path'))
-    fh = getattr(Files, 'tex_' + oldnew + '_tmp_hndl')
-    fh.write(getattr(FileContents, 'tex_' + oldnew).encode('utf-8'))
+    rev = getattr(job, name)
+    log.debug('writing to file %s', getattr(job, 'tex_' + name + '_tmp_path'))
+    fh = getattr(job, 'tex_' + name + '_tmp_hndl')
+    data = rev.tex.encode('utf-8')
+    fh.write(data)
     fh.flush()
+    job.stats.count('bytes_written', len(data))
+
+
+# top-level sectioning command at the start of a line, and its heading (allowing one level of nested braces)
+section_re = re.compile(r'^[ \t]*\\(chapter|section)\*?[ \t]*(?:\[[^\]]*\])?[ \t]*{((?:[^{}]|{[^{}]*})*)}', re.M)
+
+
+def run_latexdiff_chunked(job):
+    '''Runs latexdiff on each pair of aligned chapters (or sections if there are no chapters) of the processed
+    revisions, using up to job.max_workers latexdiff processes at once, and stitches the results into the output
+    file. Identical chapters are copied without running latexdiff. Returns False if the documents cannot be split.'''
+
+    command = 'section'
+    if any(m.group(1) == 'chapter' for rev in job.revisions for m in section_re.finditer(rev.tex)):
+        command = 'chapter'
+    old = split_sections(job.old.tex, command)
+    new = split_sections(job.new.tex, command)
+    if old is None or new is None:
+        log.info('\\begin{document} or \\end{document} not found, running latexdiff on the whole document')
+        return False
+
+    old_preamble, old_chunks, _ = old
+    new_preamble, new_chunks, new_end = new
+    pairs = align_sections(old_chunks, new_chunks)
+    log.info('running latexdiff on %d changed of %d chunks split at \\%s',
+             sum(old_chunk != new_chunk for old_chunk, new_chunk in pairs), len(pairs), command)
+
+    tmp_dir = tempfile.mkdtemp(prefix='tmp_chunks_', dir=job.config.temp_dir or None)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=job.max_workers or os.cpu_count() or 1) as executor:
+            # the preambles are diffed with an empty body, for the preamble of the output with the latexdiff markup
+            preamble = executor.submit(latexdiff_chunk, job, tmp_dir, 0, old_preamble + '\n', new_preamble + '\n')
+            futures = [executor.submit(latexdiff_chunk, job, tmp_dir, i + 1, old_preamble + old_chunk,
+                                       new_preamble + new_chunk) if old_chunk != new_chunk else None
+                       for i, (old_chunk, new_chunk) in enumerate(pairs)]
+            try:
+                preamble = preamble.result()[0]
+                bodies = [future.result()[1] if future else new_chunk for future, (_, new_chunk) in zip(futures, pairs)]
+            except BaseException:
+                # don't wait for the remaining chunks before removing the temp directory
+                cancel_latexdiff([preamble] + futures, [job])
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # stitch the preamble from latexdiff, the chunks and the end of the new document
+    log.debug('writing stitched result to %s', job.out_path)
+    with io.open(job.out_path, 'w', encoding='utf-8') as f:
+        f.write(preamble)
+        for body in bodies:
+            f.write(body)
+        f.write(new_end)
+    return True
+
+
+def split_sections(tex, command):
+    '''Splits a tex document at \\chapter or \\section (command), and returns tuple of (preamble including
+    \\begin{document}, list of (heading, text) for each chunk, rest from \\end{document}), or None if there is no
+    \\begin{document} and \\end{document}. The first chunk is the text before the first heading, with heading None.'''
+
+    begin = tex.find('\\begin{document}')
+    end = tex.rfind('\\end{document}')
+    if begin < 0 or end < begin:
+        return None
+    begin += len('\\begin{document}')
+    starts = [m for m in section_re.finditer(tex, begin, end) if m.group(1) == command]
+    bounds = [begin] + [m.start() for m in starts] + [end]
+    headings = [None] + [m.group(2).strip() for m in starts]
+    chunks = [(heading, tex[start:stop]) for heading, start, stop in zip(headings, bounds[:-1], bounds[1:])]
+    return tex[:begin], chunks, tex[end:]
+
+
+def align_sections(old_chunks, new_chunks):
+    '''Aligns chunks of the old and new document by heading, and returns list of (old text, new text). Chunks with
+    matching headings are paired, and consecutive chunks without a match are joined into one pair.'''
+
+    matcher = difflib.SequenceMatcher(None, [h for h, _ in old_chunks], [h for h, _ in new_chunks], autojunk=False)
+    pairs = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            pairs.extend((old_chunks[i][1], new_chunks[j][1]) for i, j in zip(range(i1, i2), range(j1, j2)))
+        else:
+            pairs.append((''.join(text for _, text in old_chunks[i1:i2]),
+                          ''.join(text for _, text in new_chunks[j1:j2])))
+    return pairs
+
+
+def latexdiff_chunk(job, tmp_dir, i, old_doc, new_doc):
+    '''Runs latexdiff on a chunk (the preamble and a part of the body) of the old and new document, and returns tuple
+    of (output up to and including \\begin{document}, output body)'''
+
+    old_path, new_path, out_path = [os.path.join(tmp_dir, '{}_{}.tex'.format(name, i)) for name in ['old', 'new', 'diff']]
+    old_doc += '\\end{document}\n'
+    new_doc += '\\end{document}\n'
+    if use_fifo(job.config):
+        run_latexdiff_fifo(job, old_doc, new_doc, out_path)
+    else:
+        for path, doc in [(old_path, old_doc), (new_path, new_doc)]:
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(doc)
+        run_latexdiff(job, old_path, new_path, out_path)
+    with io.open(out_path, 'r', encoding='utf-8') as f:
+        out = f.read()
+    begin = out.find('\\begin{document}')
+    end = out.rfind('\\end{document}')
+    if begin < 0 or end < begin:
+        raise ValueError('\\begin{document} or \\end{document} not found in output of latexdiff')
+    begin += len('\\begin{document}')
+    return out[:begin], out[begin:end]
+
+
+def use_fifo(config):
+    '''Returns True if latexdiff should read its input through named pipes (the latexdiff_transport setting)'''
+
+    if config.latexdiff_transport not in ['file', 'fifo']:
+        raise ValueError('latexdiff_transport must be "file" or "fifo", not "{}"'.format(config.latexdiff_transport))
+    if config.latexdiff_transport == 'fifo' and not hasattr(os, 'mkfifo'):
+        log.warning('named pipes are not supported on this system, using temp files')
+        return False
+    return config.latexdiff_transport == 'fifo'
+
+
+def run_latexdiff_fifo(job, old_tex, new_tex, out_path=None):
+    '''Runs latexdiff on old_tex and new_tex, fed through named pipes in a private temp directory instead of written
+    to temp files, and writes output to out_path (default: the output file of the job)'''
+
+    tmp_dir = tempfile.mkdtemp(prefix='tmp_fifo_', dir=job.config.temp_dir or None)
+    try:
+        paths = [os.path.join(tmp_dir, name + '.tex') for name in ['old', 'new']]
+        writers = []
+        for path, tex in zip(paths, [old_tex, new_tex]):
+            os.mkfifo(path, 0o600)
+            writer = threading.Thread(target=write_fifo, args=(path, tex.encode('utf-8')))
+            writer.daemon = True
+            writer.start()
+            writers.append(writer)
+        try:
+            run_latexdiff(job, paths[0], paths[1], out_path)
+        finally:
+            # if latexdiff has not opened a pipe (e.g. if it failed), open it here so that the writer can finish
+            for path, writer in zip(paths, writers):
+                while writer.is_alive():
+                    os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                    writer.join(0.1)
+    finally:
+        log.debug('deleting temp directory %s', tmp_dir)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_fifo(path, data):
+    '''Writes data to a named pipe, blocking until it is opened for reading'''
+
+    try:
+        with io.open(path, 'wb') as f:
+            f.write(data)
+    except (IOError, OSError):
+        # closed before everything was read
+        log.debug('named pipe %s closed before writing all data', path)
+
+
+def cancel_latexdiff(futures, jobs):
+    '''Cancels the pending futures (None is skipped) and kills the running latexdiff processes of the jobs, so that a
+    thread pool running latexdiff shuts down without running the rest when interrupted (e.g. by a signal)'''
+
+    for future in futures:
+        if future:
+            future.cancel()
+    for job in jobs:
+        with job.processes_lock:
+            job.interrupted = True
+            for process in job.processes:
+                log.debug('killing latexdiff process %d', process.pid)
+                process.kill()
+
+
+@functools.lru_cache(maxsize=None)
+def get_latexdiff_version():
+    '''Returns the version string of latexdiff, or None if latexdiff cannot be run. latexdiff is run once per process.'''
+
+    try:
+        process = subprocess.Popen(['latexdiff', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+    except OSError:
+        log.debug('could not run latexdiff --version')
+        return None
+    if process.wait():
+        return None
+    return (stdout + stderr).decode('utf-8', 'replace').strip()
+
 
+def run_latexdiff(job, file1, file2, out_path=None):
+    '''Runs latexdiff on file1 and file2 and writes output to out_path (default: the output file of the job)'''
 
-def run_latexdiff(file1, file2):
-    '''Runs latexdiff on file1 and file2 and writes output to outfile'''
+    out_path = out_path or job.out_path
+    job.stats.count('latexdiff_runs')
 
     args = ['latexdiff', file1, file2]
-    if Config.latexdiff_args:
-        args.append(Config.latexdiff_args)
+    if job.config.latexdiff_args:
+        args.append(job.config.latexdiff_args)
     log.info('running %s', ' '.join(args))
-    log.debug('sending result to %s', Files.out_path)
-    with io.open(Files.out_path, 'w', encoding='utf-8') as f:
-        process = subprocess.Popen(args, stdout=f, stderr=subprocess.PIPE)
-        _, stderr = process.communicate()
+    log.debug('sending result to %s', out_path)
+    with io.open(out_path, 'w', encoding='utf-8') as f, job.stats.timer('latexdiff'):
+        with job.processes_lock:
+            if job.interrupted:
+                raise ValueError('interrupted, not running latexdiff')
+            process = subprocess.Popen(args, stdout=f, stderr=subprocess.PIPE)
+            job.processes.add(process)
+        try:
+            _, stderr = process.communicate()
+        except BaseException:
+            # interrupted (e.g. by a signal), don't leave latexdiff running
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            with job.processes_lock:
+                job.processes.discard(process)
         ret_code = process.wait()
         if ret_code:
             raise ValueError('latexdiff returned with code {}. Error from latexdiff:\n\n'.format(ret_code) + stderr)
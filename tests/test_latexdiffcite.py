@@ -5,10 +5,17 @@ from __future__ import division, print_function, absolute_import, unicode_litera
 
 import io
 import os
+import sys
+import glob
 import json
+import time
 import shutil
+import signal
+import logging
+import threading
 import itertools
 import subprocess
+import concurrent.futures
 
 import pytest
 
@@ -16,42 +23,39 @@ from latexdiffcite import latexdiffcite
 
 real_popen = subprocess.Popen
 real_json_load = json.load
-real_destroy_tempfiles = latexdiffcite.Files.destroy_tempfiles
-
-
-def reset_everything():
-    latexdiffcite.References.refkeys_old = []
-    latexdiffcite.References.refkeys_new = []
-    latexdiffcite.References.capture_groups_old = {}
-    latexdiffcite.References.capture_groups_new = {}
-    latexdiffcite.References.authyear_old = {}
-    latexdiffcite.References.authyear_new = {}
-
-    latexdiffcite.Files.out_path = None
-    latexdiffcite.Files.tex_old_path = None
-    latexdiffcite.Files.tex_new_path = None
-    latexdiffcite.Files.bbl_old_path = None
-    latexdiffcite.Files.bbl_new_path = None
-    latexdiffcite.Files.bib_old_path = []
-    latexdiffcite.Files.bib_new_path = []
-    latexdiffcite.Files.tex_old_tmp_path = None
-    latexdiffcite.Files.tex_old_tmp_hndl = None
-    latexdiffcite.Files.tex_new_tmp_path = None
-    latexdiffcite.Files.tex_new_tmp_hndl = None
-
-    latexdiffcite.FileContents.tex_old = ''
-    latexdiffcite.FileContents.tex_new = ''
-    latexdiffcite.FileContents.bib_old = []
-    latexdiffcite.FileContents.bib_new = []
-    latexdiffcite.FileContents.bbl_old = ''
-    latexdiffcite.FileContents.bbl_new = ''
-
-    latexdiffcite.Config.load_defaults()
+real_destroy_tempfiles = latexdiffcite.DiffJob.destroy_tempfiles
 
 
 parser = latexdiffcite.create_parser()
 
 
+def run_job(args):
+    '''Runs a job from command line arguments (with logging set up as in main()) and returns the job, so that the
+    temp files can be checked'''
+    parsed_args = parser.parse_args(args)
+    logging_state = latexdiffcite.setup_logging(parsed_args)
+    try:
+        job = latexdiffcite.initiate_from_args(parsed_args)
+        latexdiffcite.run(job)
+    finally:
+        latexdiffcite.remove_logging(logging_state)
+    return job
+
+
+def read_tempfiles(job):
+    '''Returns contents of the old and new temp files of a job, and deletes them. Identical revisions are not written
+    to temp files, but directly to the output file.'''
+    if job.tex_old_tmp_path is None:
+        out = read_file(job.out_path)
+        return out, out
+    try:
+        job.tex_old_tmp_hndl.seek(0)
+        job.tex_new_tmp_hndl.seek(0)
+        return job.tex_old_tmp_hndl.read().decode('utf-8'), job.tex_new_tmp_hndl.read().decode('utf-8')
+    finally:
+        real_destroy_tempfiles(job)
+
+
 # ==============================================================================
 #  Outputs
 # ==============================================================================
@@ -183,19 +187,56 @@ class mock_popen():
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
+        if self.args[0][0] == 'git':
+            # called from GitCatFile: read files from the git index instead of HEAD
+            self.process = real_popen(*args, **kwargs)
+            self.stdin = mock_stdin(self.process.stdin)
+            self.stdout = self.process.stdout
+            self.stderr = self.process.stderr
 
     def communicate(self):
-        if self.args[0][0] == 'git':
-            # called from git_show
-            return real_popen([x.replace('HEAD', '') for x in self.args[0]], **self.kwargs).communicate()
-        else:
-            # called from run_latexdiff
-            return None, None
+        # called from run_latexdiff
+        return None, None
 
     def wait(self):
+        if self.args[0][0] == 'git':
+            return self.process.wait()
         return 0
 
 
+class mock_stdin():
+    '''Used to mock stdin of git cat-file, replacing HEAD:path by :path (the index)'''
+
+    def __init__(self, stdin):
+        self.stdin = stdin
+
+    def write(self, s):
+        self.stdin.write(s.replace(b'HEAD:', b':'))
+
+    def flush(self):
+        self.stdin.flush()
+
+    def close(self):
+        self.stdin.close()
+
+
+def mock_run_latexdiff(job, file1, file2, out_path=None):
+    '''Used to mock run_latexdiff, writes the new revision to the output file'''
+    with open(file2, 'rb') as f_in, open(out_path or job.out_path, 'wb') as f_out:
+        f_out.write(f_in.read())
+
+
+def git_commit(tmpdir, files):
+    '''Writes files (dict of path -> contents) in tmpdir and commits them to a git repository there'''
+    git = ['git', '-C', str(tmpdir), '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+    if not tmpdir.join('.git').check():
+        subprocess.check_call(git + ['init', '-q'])
+    for fname, contents in files.items():
+        tmpdir.join(fname).write(contents, ensure=True)
+    subprocess.check_call(git + ['add', '.'])
+    subprocess.check_call(git + ['commit', '-q', '-m', 'test'])
+
+
 def generate_json_load_inject_encoding(enc):
 
     def json_load_inject_encoding(f):
@@ -255,26 +296,16 @@ class TestHolistic():
         folder = os.path.join('tests', '{}_{}'.format(enc, eol))
         mocker.patch('latexdiffcite.latexdiffcite.subprocess.Popen', new=mock_popen)
         mocker.patch('latexdiffcite.latexdiffcite.json.load', new=generate_json_load_inject_encoding(enc))
-        mocker.patch('latexdiffcite.latexdiffcite.Files.destroy_tempfiles')
+        mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
         args = testcases[testcase]['template_args_' + mode].replace('%FILE%', os.path.join(folder, 'test.tex')).split()
         args.extend(['-o', str(tmpdir.join('diff.tex'))])
-        latexdiffcite.main(args)
-        latexdiffcite.Files.tex_old_tmp_hndl.seek(0)
-        latexdiffcite.Files.tex_new_tmp_hndl.seek(0)
-        out_old = latexdiffcite.Files.tex_old_tmp_hndl.read().decode('utf-8')
-        out_new = latexdiffcite.Files.tex_new_tmp_hndl.read().decode('utf-8')
+        out_old, out_new = read_tempfiles(run_job(args))
         out_true = testcases[testcase]['out'].replace('{ACCENTED_CHARACTERS}', encs[enc])
         if enc != 'ascii':
             out_true = out_true.replace('Foo and Bar', 'Föø and Bår')
         assert out_old == out_true
         assert out_new == out_true
 
-    def setup(self):
-        reset_everything()
-
-    def teardown(self):
-        real_destroy_tempfiles()
-
 
 # ==============================================================================
 #  Parametrize a test function to test all examples in the docs
@@ -292,7 +323,7 @@ class TestExamples():
     @pytest.mark.parametrize('folder', paths, ids=folders)
     def test_example(self, mocker, tmpdir, folder):
         mocker.patch('latexdiffcite.latexdiffcite.subprocess.Popen', new=mock_popen)
-        mocker.patch('latexdiffcite.latexdiffcite.Files.destroy_tempfiles')
+        mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
         f_tex = os.path.join(folder, 'input.tex')
         f_cfg = os.path.join(folder, 'config.json')
         f_out = os.path.join(folder, 'output.tex')
@@ -300,24 +331,13 @@ class TestExamples():
         if 'input.bbl' in os.listdir(folder):
             args.append('--bbl')
         args.extend(['-o', str(tmpdir.join('diff.tex'))])
-        parsed_args = parser.parse_args(args)
-        latexdiffcite.initiate_from_args(parsed_args)
-        latexdiffcite.run(parsed_args)
-        latexdiffcite.Files.tex_old_tmp_hndl.seek(0)
-        latexdiffcite.Files.tex_new_tmp_hndl.seek(0)
-        out_old = latexdiffcite.Files.tex_old_tmp_hndl.read().decode('utf-8')
-        out_new = latexdiffcite.Files.tex_new_tmp_hndl.read().decode('utf-8')
-        with io.open(f_out, encoding=latexdiffcite.Config.encoding) as f:
+        job = run_job(args)
+        out_old, out_new = read_tempfiles(job)
+        with io.open(f_out, encoding=job.config.encoding) as f:
             out_answer = f.read()
         assert out_old == out_answer
         assert out_new == out_answer
 
-    def setup(self):
-        reset_everything()
-
-    def teardown(self):
-        real_destroy_tempfiles()
-
 
 # ==============================================================================
 #  Test specific functions for special cases
@@ -326,68 +346,153 @@ class TestExamples():
 
 class TestIndividualFunctions():
 
-    def setup(self):
-        reset_everything()
-
     def test_format_authorlist_with_serialcomma(self, mocker):
-        latexdiffcite.Config.bib = {
+        config = latexdiffcite.Config()
+        config.bib = {
             'max_authors': 0,  # not used
             'sep_authors_first': ', ',
             'author_serialcomma': True,
             'sep_authors_last': ' and ',
             'et_al': 'NOTUSED'
         }
-        latexdiffcite.Config.sep_authors_first = ', '
-        latexdiffcite.Config.author_serialcomma = True
-        latexdiffcite.Config.sep_authors_last = ' and '
-        assert latexdiffcite.format_authorlist(['Foo']) == 'Foo'
-        assert latexdiffcite.format_authorlist(['Foo', 'Bar']) == 'Foo and Bar'
-        assert latexdiffcite.format_authorlist(['Foo', 'Bar', 'Baz']) == 'Foo, Bar, and Baz'
+        assert latexdiffcite.format_authorlist(['Foo'], config) == 'Foo'
+        assert latexdiffcite.format_authorlist(['Foo', 'Bar'], config) == 'Foo and Bar'
+        assert latexdiffcite.format_authorlist(['Foo', 'Bar', 'Baz'], config) == 'Foo, Bar, and Baz'
 
     def test_format_authorlist_without_serialcomma(self, mocker):
-        latexdiffcite.Config.bib = {
+        config = latexdiffcite.Config()
+        config.bib = {
             'max_authors': 0,  # not used
             'sep_authors_first': ', ',
             'author_serialcomma': False,
             'sep_authors_last': ' & ',
             'et_al': 'NOTUSED'
         }
-        assert latexdiffcite.format_authorlist(['Foo']) == 'Foo'
-        assert latexdiffcite.format_authorlist(['Foo', 'Bar']) == 'Foo & Bar'
-        assert latexdiffcite.format_authorlist(['Foo', 'Bar', 'Baz']) == 'Foo, Bar & Baz'
+        assert latexdiffcite.format_authorlist(['Foo'], config) == 'Foo'
+        assert latexdiffcite.format_authorlist(['Foo', 'Bar'], config) == 'Foo & Bar'
+        assert latexdiffcite.format_authorlist(['Foo', 'Bar', 'Baz'], config) == 'Foo, Bar & Baz'
 
     def test_custom_cite_command(self, mocker):
-        latexdiffcite.FileContents.tex_new = r'\custom_cite{foo, bar}'
-        latexdiffcite.References.refkeys_new = []
-        latexdiffcite.Config.cmd_format = {'custom_cite': 'foo'}
-        latexdiffcite.get_all_ref_keys('new')
-        assert latexdiffcite.References.refkeys_new == ['foo', 'bar']
+        rev = latexdiffcite.Revision('new', 'foo.tex')
+        rev.tex = r'\custom_cite{foo, bar}'
+        rev.config.cmd_format = {'custom_cite': 'foo'}
+        latexdiffcite.get_all_ref_keys(rev)
+        assert list(rev.refkeys) == ['foo', 'bar']
+
+    def test_ref_keys_numbered(self):
+        '''Test that each unique reference key is numbered once, in order of first appearance'''
+        rev = latexdiffcite.Revision('new', 'foo.tex')
+        rev.tex = r'\citep{foo, bar} \citet{bar} \citep{baz, foo} %\citep{qux}'
+        latexdiffcite.get_all_ref_keys(rev)
+        assert list(rev.refkeys.items()) == [('foo', 1), ('bar', 2), ('baz', 3)]
+        rev.authyear = dict.fromkeys(rev.refkeys, ('', ''))
+        rev.capture_groups = dict.fromkeys(rev.refkeys, ())
+        rev.config.cmd_format['citep']['author'] = '%NUMERIC%'
+        assert latexdiffcite.format_refs(rev, ['baz', 'foo'], 'citep', None, None).count('3') == 1
+
+    def test_compile_template(self):
+        '''Test that templates are split into literal text and tokens, and that unused tokens are kept'''
+        segments = latexdiffcite.compile_template('%CG2% (%AUTHOR%, %YEAR%)%CG0%', ('AUTHOR',))
+        assert segments == [('CG', 1), (None, ' ('), ('AUTHOR', None), (None, ', %YEAR%)%CG0%')]
+        assert latexdiffcite.compile_template('%CG2% (%AUTHOR%, %YEAR%)%CG0%', ('AUTHOR',)) is segments
+        assert latexdiffcite.render_template(segments, ('a', None), {'AUTHOR': 'Foo'}) == ' (Foo, %YEAR%)%CG0%'
+        assert latexdiffcite.render_template(segments, ('a',), {'AUTHOR': 'Foo'}) == '%CG2% (Foo, %YEAR%)%CG0%'
+
+    def test_format_refs_memo(self, mocker):
+        '''Test that repeated citation commands are formatted once, and that the memo is bounded'''
+        mocker.patch('latexdiffcite.latexdiffcite.format_refs_memo_size', 2)
+        rev = latexdiffcite.Revision('new', 'foo.tex')
+        rev.tex = r'\citep{foo, bar} \citep{foo, bar} \citep[e.g.][]{foo, bar} \citet{bar} \citep{foo, bar}'
+        latexdiffcite.get_all_ref_keys(rev)
+        rev.authyear = {'foo': ('Foo', '2010'), 'bar': ('Bar', '2011')}
+        rev.capture_groups = dict.fromkeys(rev.refkeys, ())
+        spy = mocker.spy(latexdiffcite, 'render_template')
+        latexdiffcite.replace_refs_in_tex(rev)
+        assert rev.tex.count('[\\ldiffentity{\\textit{Foo}, \\ldiffentity{2010}}; '
+                             '\\ldiffentity{\\textit{Bar}, \\ldiffentity{2011}}]') == 3
+        # formatted four times (the first command is forgotten before it is repeated last), two templates per key
+        assert spy.call_count == 2 * (2 + 2 + 1 + 2)
+        assert len(rev.formatted_refs) == 2
+        assert rev.stats.counters['citations_memoized'] == 1
+
+    def test_scan_citations(self):
+        '''Test spans, notes and keys of scanned citation commands, and that comments are skipped'''
+        s = 'a \\citep[e.g.][post]{foo, bar} % \\cite{notused}\nb \\citet [x] {baz}\\cite{foo,\n qux}'
+        citations = latexdiffcite.scan_citations(s, latexdiffcite.Config().cmd_format)
+        assert [c.command for c in citations] == ['citep', 'citet', 'cite']
+        assert [c.keys for c in citations] == [['foo', 'bar'], ['baz'], ['foo', 'qux']]
+        assert [(c.prenote, c.postnote) for c in citations] == [('e.g.', 'post'), (None, 'x'), (None, None)]
+        assert [s[c.start:c.end] for c in citations] == ['\\citep[e.g.][post]{foo, bar}', '\\citet [x] {baz}',
+                                                         '\\cite{foo,\n qux}']
+        # a } in a comment in the reference keys does not end the command
+        s = '\\citep{foo, % see }\n baz} text'
+        citations = latexdiffcite.scan_citations(s, latexdiffcite.Config().cmd_format)
+        assert [c.keys for c in citations] == [['foo', 'baz']]
+        assert s[citations[0].end:] == ' text'
+
+    def test_replace_refs_in_tex_custom_cite_command(self):
+        '''Test that citation commands added to the config are replaced'''
+        rev = latexdiffcite.Revision('new', 'foo.tex')
+        rev.config.cmd_format['custom_cite'] = rev.config.cmd_format['citenum']
+        rev.config.ref_single_word = False
+        rev.tex = r'\custom_cite{foo} \cite{foo}'
+        latexdiffcite.get_all_ref_keys(rev)
+        rev.authyear = {'foo': ('Foo', '2010')}
+        rev.capture_groups = {'foo': ()}
+        latexdiffcite.replace_refs_in_tex(rev)
+        assert rev.tex == r'[\textit{Foo} [2010]] [\textit{Foo} [2010]]'
+
+    def test_replace_refs_in_tex_keeps_comments(self):
+        '''Test that only the matched command is replaced, not identical commands in comments'''
+        rev = latexdiffcite.Revision('new', 'foo.tex')
+        rev.config.ref_single_word = False
+        rev.tex = '\\cite{foo} % \\cite{foo}\n\\cite{foo}'
+        latexdiffcite.get_all_ref_keys(rev)
+        rev.authyear = {'foo': ('Foo', '2010')}
+        rev.capture_groups = {'foo': ()}
+        latexdiffcite.replace_refs_in_tex(rev)
+        assert rev.tex == '[\\textit{Foo} [2010]] % \\cite{foo}\n[\\textit{Foo} [2010]]'
 
     def test_git_force_unix_pathsep(self, mocker):
-        '''Test that path separators are correctly handled based on Config.git_force_unix_pathsep'''
+        '''Test that path separators are correctly handled based on git_force_unix_pathsep'''
         mocked_popen = mocker.patch('latexdiffcite.latexdiffcite.subprocess.Popen')
-        mocked_popen.return_value.communicate.return_value = None, None
-        mocked_popen.return_value.wait.return_value = 0
+        process = mocked_popen.return_value
+        process.stdout.readline.return_value = b'0123abcd blob 3\n'
+        process.stdout.read.return_value = b'foo'
+        git = latexdiffcite.GitCatFile()
 
         # test that file endings are converted
-        latexdiffcite.Config.git_force_unix_pathsep = True
-        latexdiffcite.git_show('path\\to\\file.tex', 'HEAD')
-        args, kwargs = mocked_popen.call_args
-        assert args[0] == ['git', 'show', 'HEAD:path/to/file.tex']
+        assert git.read('path\\to\\file.tex', 'HEAD', True) == ('0123abcd', b'foo')
+        process.stdin.write.assert_called_with(b'HEAD:path/to/file.tex\n')
 
         # test that file endings are not converted
-        latexdiffcite.Config.git_force_unix_pathsep = False
-        latexdiffcite.git_show('path\\to\\file.tex', 'HEAD')
-        args, kwargs = mocked_popen.call_args
-        assert args[0] == ['git', 'show', 'HEAD:path\\to\\file.tex']
-
-    def test_git_show_retcode_exception(self, mocker):
-        '''Test exception raised when git has nonzero return code'''
-        mocked_popen = mocker.patch('latexdiffcite.latexdiffcite.subprocess.Popen')
-        mocked_popen.return_value.communicate.return_value = 'stdout', 'stderr'
-        mocked_popen.return_value.wait.return_value = 1
-        with pytest.raises(ValueError):
-            latexdiffcite.git_show('foo', 'bar')
+        git.read('path\\to\\file.tex', 'HEAD', False)
+        process.stdin.write.assert_called_with(b'HEAD:path\\to\\file.tex\n')
+        git.close()
+
+        # a single git process is used for all files
+        assert mocked_popen.call_count == 1
+        assert mocked_popen.call_args[0][0] == ['git', 'cat-file', '--batch']
+
+    def test_git_cat_file(self):
+        '''Test reading files from the git index, and exception raised when a file is missing'''
+        fname = 'tests/ascii_LF/test.tex'
+        git = latexdiffcite.GitCatFile()
+        try:
+            oid1, contents = git.read(fname, '')
+            oid2, _ = git.read(fname.replace('ascii', 'utf-8'), '')
+            assert contents == read_file(fname).encode('ascii')
+            assert oid1 != oid2
+            assert git.read(fname, '') == (oid1, contents)
+            with pytest.raises(ValueError):
+                git.read('nonexistent.tex', '')
+            # the git process is still usable after a missing file
+            assert git.read(fname, '')[0] == oid1
+            # missing files with spaces in the path
+            assert git.read_many([fname, 'my dir/missing.tex', fname], '', missing_ok=True) == [
+                (oid1, contents), (None, None), (oid1, contents)]
+        finally:
+            git.close()
 
     def test_run_latexdiff_retcode_exception(self, mocker):
         '''Test exception raised when latexdiff has nonzero return code'''
@@ -395,55 +500,517 @@ class TestIndividualFunctions():
         mocked_popen.return_value.communicate.return_value = 'stdout', 'stderr'
         mocked_popen.return_value.wait.return_value = 1
         mocked_popen = mocker.patch('latexdiffcite.latexdiffcite.io.open', autospec=True)
-        latexdiffcite.Files.out_path = 'foo'
+        job = latexdiffcite.DiffJob('foo', 'bar', 'foo')
         with pytest.raises(ValueError):
-            latexdiffcite.run_latexdiff('foo', 'bar')
+            latexdiffcite.run_latexdiff(job, 'foo', 'bar')
 
     def test_get_capture_groups_from_bbl_key_not_in_file(self):
         '''Tests exception raised when reference does not exist in the bbl file'''
-        latexdiffcite.FileContents.bbl_old = 'foo'
-        latexdiffcite.References.refkeys_old = ['bar']
+        rev = latexdiffcite.Revision('old', 'foo.tex')
+        rev.bbl = 'foo'
+        rev.refkeys = ['bar']
         with pytest.raises(ValueError):
-            latexdiffcite.get_capture_groups_from_bbl('old')
+            latexdiffcite.get_capture_groups_from_bbl(rev)
 
     def test_get_capture_groups_from_bbl_wrong_regex(self):
         '''Tests exception raised when reference is not matched in bbl file by the regex'''
-        latexdiffcite.Config.bbl['regex'] = r'baz%REFKEY%'
-        latexdiffcite.FileContents.bbl_old = 'foo'
-        latexdiffcite.References.refkeys_old = ['foo']
+        rev = latexdiffcite.Revision('old', 'foo.tex')
+        rev.config.bbl['regex'] = r'baz%REFKEY%'
+        rev.bbl = 'foo'
+        rev.refkeys = ['foo']
         with pytest.raises(ValueError):
-            latexdiffcite.get_capture_groups_from_bbl('old')
+            latexdiffcite.get_capture_groups_from_bbl(rev)
+
+    def test_index_bbl_items(self):
+        '''Test that bibitems are indexed by key, also with nested braces and brackets in the label'''
+        bbl = ('\\bibitem[{\\textit{Foo}(2011{\\natexlab{a}})}]{foo2011}\nInfo\n\n'
+               '\\bibitem[{[x]}] {bar+2}\nInfo\n\n\\bibitem{baz}\nInfo\n')
+        index = latexdiffcite.index_bbl_items(bbl)
+        assert sorted(index) == ['bar+2', 'baz', 'foo2011']
+        start, end = index['bar+2']
+        assert bbl[start:end] == '\\bibitem[{[x]}] {bar+2}\nInfo\n\n'
+
+    def test_get_capture_groups_from_bbl_regex_metacharacters(self):
+        '''Test that reference keys containing regex metacharacters are found in the bbl file'''
+        rev = latexdiffcite.Revision('old', 'foo.tex')
+        rev.config.bbl['regex'] = r'\\bibitem\[(.*?)\]{%REFKEY%}'
+        rev.bbl = '\\bibitem[Foo10]{foo+10}\n\n\\bibitem[Bar11]{bar(11)}\n'
+        rev.refkeys = ['bar(11)', 'foo+10']
+        latexdiffcite.get_capture_groups_from_bbl(rev)
+        assert rev.capture_groups == {'foo+10': ('Foo10',), 'bar(11)': ('Bar11',)}
 
     def test_find_bibfiles_not_found(self):
         '''Test exception raised when bibfiles are not found'''
-        latexdiffcite.Files.tex_old_path = ''
-        latexdiffcite.References.refkeys_old = ['foo']
+        rev = latexdiffcite.Revision('old', '')
+        rev.refkeys = ['foo']
         with pytest.raises(IOError):
-            latexdiffcite.find_bibfiles('bibfile', 'old')
+            latexdiffcite.find_bibfiles('bibfile', rev)
         with pytest.raises(IOError):
-            latexdiffcite.find_bibfiles('bib1, bib2', 'old')
+            latexdiffcite.find_bibfiles('bib1, bib2', rev)
 
     def test_make_author_year_tokens_from_bib_no_bibfiles(self):
         '''Tests a path that should never happen, but required to reach 100% test coverage, so why not
         (basically, tests exception raised when searching for refs in bibfiles when there are no bibfiles)'''
-        latexdiffcite.References.refkeys_old = ['foo']
+        rev = latexdiffcite.Revision('old', 'foo.tex')
+        rev.refkeys = ['foo']
         with pytest.raises(ValueError):
-            latexdiffcite.make_author_year_tokens_from_bib('old')
+            latexdiffcite.make_author_year_tokens_from_bib(rev)
 
     def test_make_author_year_tokens_from_bib_not_found(self):
         '''Tests exception raised when reference does not exist in bib file(s)'''
-        latexdiffcite.References.refkeys_old = ['foo']
-        latexdiffcite.FileContents.bib_old = ['bar']
+        rev = latexdiffcite.Revision('old', 'foo.tex')
+        rev.refkeys = ['foo']
+        rev.bib = ['bar']
         with pytest.raises(ValueError):
-            latexdiffcite.make_author_year_tokens_from_bib('old')
+            latexdiffcite.make_author_year_tokens_from_bib(rev)
+
+    @pytest.mark.parametrize('bib_reader', ['read', 'stream', 'mmap'])
+    def test_make_author_year_tokens_from_bib_first_file_wins(self, tmpdir, bib_reader):
+        '''Tests that each bib file is looked up once for the references not found in the previous files, and that
+        the remaining files are skipped when all references are found'''
+        bibs = ['@article{foo,\n  author = {Foo, A},\n  year = {2010}\n}\n',
+                '@article{foo,\n  author = {Baz, A},\n  year = {2012}\n}\n@article{bar,\n  author = {Bar, A},\n'
+                '  year = {2011}\n}\n',
+                '@article{qux,\n  author = {Qux, A},\n  year = {2013}\n}\n']
+        rev = latexdiffcite.Revision('old', 'foo.tex')
+        rev.config.bib_reader = bib_reader
+        for i, bib in enumerate(bibs):
+            tmpdir.join('bib{}.bib'.format(i)).write(bib)
+            rev.bib_paths.append(str(tmpdir.join('bib{}.bib'.format(i))))
+        rev.bib = bibs if bib_reader == 'read' else []
+        rev.refkeys = ['foo', 'bar']
+        bib_files = {}
+        latexdiffcite.make_author_year_tokens_from_bib(rev, bib_files=bib_files)
+        assert rev.authyear == {'foo': ('Foo', '2010'), 'bar': ('Bar', '2011')}
+        # foo is not looked up in the second file, and the third file is not looked up (or read) at all
+        assert [sorted(bibfile.entries) for bibfile in bib_files.values()] == [['bar', 'foo'], ['bar'], []]
+        assert [bibfile.n_scanned for bibfile in bib_files.values()] == [1, 2, 0]
+
+    def test_make_author_year_tokens_from_bib_shared(self, tmpdir):
+        '''Tests that a bib file used by both revisions is read once, references cited by both are resolved once, and
+        duplicate authors are still corrected per revision'''
+        tmpdir.join('refs.bib').write('@article{foo,\n  author = {Foo, A},\n  year = {2010}\n}\n'
+                                      '@article{foo2,\n  author = {Foo, A},\n  year = {2010}\n}\n'
+                                      '@article{bar,\n  author = {Bar, A},\n  year = {2011}\n}\n')
+        old = latexdiffcite.Revision('old', str(tmpdir.join('old.tex')))
+        new = latexdiffcite.Revision('new', str(tmpdir.join('new.tex')))
+        old.tex = new.tex = 'text\n\\bibliography{refs}\n'
+        includes, bib_files, bib_tables = {}, {}, {}
+        for rev, refkeys in [(old, ['foo', 'foo2', 'bar']), (new, ['foo', 'bar'])]:
+            latexdiffcite.read_bibfile(rev, includes=includes)
+            rev.refkeys = refkeys
+            latexdiffcite.make_author_year_tokens_from_bib(rev, bib_files=bib_files, bib_tables=bib_tables)
+        assert old.stats.counters['bytes_read'] > 0
+        assert 'bytes_read' not in new.stats.counters
+        assert old.authyear == {'foo': ('Foo', '2010a'), 'foo2': ('Foo', '2010b'), 'bar': ('Bar', '2011')}
+        assert new.authyear == {'foo': ('Foo', '2010'), 'bar': ('Bar', '2011')}
+        assert old.stats.counters['bib_references_shared'] == 0
+        assert new.stats.counters['bib_references_shared'] == 2
+        assert new.stats.counters['bib_entries_parsed'] == 0
+        assert len(bib_tables) == 1
+
+    def test_index_bib_entries(self):
+        '''Test that bib entries are indexed by key, first entry wins, and keys are not treated as regex'''
+        bib = '@article{foo+1,\n  year = {2010}\n}\n@Book { bar ,\n  year = {2011}\n}\n@article{foo+1,\n}\n'
+        index = latexdiffcite.index_bib_entries(bib)
+        assert sorted(index) == ['bar', 'foo+1']
+        start, end = index['foo+1']
+        assert bib[start:end] == '@article{foo+1,\n  year = {2010}\n}'
+        start, end = index['bar']
+        assert bib[start:end].strip().endswith('{2011}\n}')
+
+    def test_bib_cache(self, tmpdir):
+        '''Test that parsed bib entries are stored per content hash, and least recently used files are evicted'''
+        cache = latexdiffcite.BibCache(str(tmpdir), 2)
+        bibfile = latexdiffcite.BibFile('@article{foo,\n  author = {Foo, A},\n  year = {2010}\n}\n', cache)
+        assert bibfile.lookup('foo') == (['Foo'], '2010')
+        assert bibfile.lookup('bar') is None
+        cache.close()
+
+        cache = latexdiffcite.BibCache(str(tmpdir), 2)
+        assert cache.load(bibfile.digest) == {'foo': (['Foo'], '2010'), 'bar': None}
+        cache.store('otherdigest', 'baz', None)
+        cache.load('otherdigest')
+        cache.close()
+
+        cache = latexdiffcite.BibCache(str(tmpdir), 2)
+        assert cache.load(bibfile.digest) == {}
+        assert cache.load('otherdigest') == {'baz': None}
+        cache.close()
+
+    def test_bib_cache_opened_at_once(self, tmpdir, mocker):
+        '''Test that a cache opened while another instance is creating it is not cleared (a second instance is opened
+        right after the first has looked for the version)'''
+        real_connect = latexdiffcite.sqlite3.connect
+        cache_dir = str(tmpdir.join('cache'))
+
+        def open_second():
+            cache = latexdiffcite.BibCache(cache_dir, 10)
+            cache.store('digest', 'foo', (['Foo'], '2010'))
+            cache.close()
+
+        class HookedConnection(object):
+            '''Connection opening the second instance after looking for the version'''
+            def __init__(self, db):
+                self.db = db
+
+            def __getattr__(self, name):
+                return getattr(self.db, name)
+
+            def __enter__(self):
+                return self.db.__enter__()
+
+            def __exit__(self, *args):
+                return self.db.__exit__(*args)
+
+            def execute(self, sql, *args):
+                cursor = self.db.execute(sql, *args)
+                if 'FROM meta' in sql:
+                    second = threading.Thread(target=open_second)
+                    threads.append(second)
+                    second.start()
+                    # the second instance waits for the first to create the tables
+                    second.join(1)
+                return cursor
+
+        def mock_connect(*args, **kwargs):
+            db = real_connect(*args, **kwargs)
+            return db if threads else HookedConnection(db)
+
+        threads = []
+        mocker.patch('latexdiffcite.latexdiffcite.sqlite3.connect', side_effect=mock_connect)
+        first = latexdiffcite.BibCache(cache_dir, 10)
+        first.close()
+        threads[0].join()
+        cache = latexdiffcite.BibCache(cache_dir, 10)
+        assert cache.load('digest') == {'foo': (['Foo'], '2010')}
+        cache.close()
+
+    def test_bib_cache_skips_parsing(self, tmpdir, mocker):
+        '''Test that bib files are not indexed when all cited entries are cached'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        fname = os.path.join('tests', 'ascii_LF', 'test.tex')
+        cache_dir = str(tmpdir.join('cache'))
+        args = ['file', fname, fname, '-s', '--cache-dir', cache_dir, '-o', str(tmpdir.join('diff.tex'))]
+        latexdiffcite.main(args)
+        assert os.path.isfile(os.path.join(cache_dir, latexdiffcite.BibCache.filename))
+        index_bib_entries = mocker.patch('latexdiffcite.latexdiffcite.index_bib_entries',
+                                         wraps=latexdiffcite.index_bib_entries)
+        latexdiffcite.main(args)
+        assert not index_bib_entries.called
+        latexdiffcite.main(args + ['--no-cache'])
+        assert index_bib_entries.called
+
+    def test_iter_bib_entries(self):
+        '''Test that bib entries are yielded in order, and only the entries of the given keys are kept'''
+        lines = ['% comment\n', '@article{foo,\n', '  author = {Foo, A},\n', '}\n', '\n', '@book{bar,\n', '}\n',
+                 '@misc{unterminated,\n']
+        assert list(latexdiffcite.iter_bib_entries(lines)) == [('foo', ''.join(lines[1:4])), ('bar', ''.join(lines[5:7]))]
+        assert list(latexdiffcite.iter_bib_entries(lines, {'bar'})) == [('foo', None), ('bar', ''.join(lines[5:7]))]
+
+    def test_iter_bib_entries_key_on_next_line(self):
+        '''Test that the streamed reader finds the same entries as the indexer when the key is not on the line of the
+        entry type'''
+        contents = ('@string{foo = "bar"}\n@comment{\n}\n@\n@article{\n  foo,\n  author = {Foo, A},\n  year = {2010}\n}\n'
+                    '@book\n{ bar\n , author = {Bar, B}, year = {2011}\n}\n@misc{baz, year = {2012}\n}\n')
+        lines = contents.splitlines(True)
+        index = latexdiffcite.index_bib_entries(contents)
+        assert sorted(index) == ['bar', 'baz', 'foo']
+        entries = list(latexdiffcite.iter_bib_entries(lines))
+        assert [refkey for refkey, entry in entries] == ['foo', 'bar', 'baz']
+        for refkey, entry in entries:
+            assert entry.strip() == contents[slice(*index[refkey])].strip()
+        assert list(latexdiffcite.iter_bib_entries(lines, {'bar'})) == [('foo', None), entries[1], ('baz', None)]
+
+    @pytest.mark.parametrize('folder', ['ascii_LF', 'utf-8_CRLF', 'latin-1_LF'])
+    def test_streamed_bibfiles(self, tmpdir, folder):
+        '''Test that streamed bib files give the same result as bib files read into memory, and share the cache'''
+        fname = os.path.join('tests', folder, 'test.tex')
+        config = latexdiffcite.Config()
+        config.encoding = folder.split('_')[0]
+        config.cache_dir = str(tmpdir)
+        job_read = latexdiffcite.DiffJob(fname, fname, config=config)
+        latexdiffcite.process_job(job_read)
+        config.bib_reader = 'stream'
+        job_stream = latexdiffcite.DiffJob(fname, fname, config=config)
+        latexdiffcite.process_job(job_stream)
+        assert job_stream.old.bib == []
+        assert job_stream.old.tex == job_read.old.tex
+        # the second revision only looks up the entries read for the first one
+        assert job_stream.old.stats.counters['bib_entries_scanned'] > 0
+        assert job_stream.new.stats.counters['bib_entries_scanned'] == 0
+        # the entries were cached by the first job (same content hash), so none are parsed
+        assert job_stream.old.stats.counters['bib_entries_parsed'] == 0
+
+        config.bib_reader = 'foo'
+        with pytest.raises(ValueError):
+            latexdiffcite.process_job(latexdiffcite.DiffJob(fname, fname, config=config))
+
+    @pytest.mark.parametrize('folder', ['ascii_LF', 'utf-8_CRLF', 'latin-1_LF'])
+    def test_mapped_bibfiles(self, tmpdir, folder):
+        '''Test that memory-mapped bib files give the same result as bib files read into memory'''
+        fname = os.path.join('tests', folder, 'test.tex')
+        config = latexdiffcite.Config()
+        config.encoding = folder.split('_')[0]
+        job_read = latexdiffcite.DiffJob(fname, fname, config=config)
+        latexdiffcite.process_job(job_read)
+        config.bib_reader = 'mmap'
+        config.cache_dir = str(tmpdir)
+        job_mmap = latexdiffcite.DiffJob(fname, fname, config=config)
+        latexdiffcite.process_job(job_mmap)
+        assert job_mmap.old.bib == []
+        assert job_mmap.old.tex == job_read.old.tex
+        assert tmpdir.join('bibindex').listdir()
+        # the files are unmapped when the job is processed
+        assert job_mmap.bib_files and all(bibfile.map is None for bibfile in job_mmap.bib_files.values())
+
+    def test_mapped_bibfile_index(self, tmpdir):
+        '''Test that the offsets of bib entries are stored and reused while the file is unchanged'''
+        path = tmpdir.join('refs.bib')
+        path.write_binary('@article{foo,\r\n  author = {Föø, A},\r\n  year = {2010}\r\n}\r\n'.encode('latin-1'))
+        index_dir = str(tmpdir.join('index'))
+        bibfile = latexdiffcite.MappedBibFile(str(path), 'latin-1', None, index_dir)
+        assert bibfile.lookup('foo') == (['Föø'], '2010')
+        assert bibfile.lookup('bar') is None
+        assert bibfile.n_scanned == 1
+
+        bibfile = latexdiffcite.MappedBibFile(str(path), 'latin-1', None, index_dir)
+        assert bibfile.lookup('foo') == (['Föø'], '2010')
+        assert bibfile.n_scanned == 0
+
+        path.write('@article{bar,\n  author = {Bar, A},\n  year = {2011}\n}\n', mode='a')
+        os.utime(str(path), (time.time() + 10, time.time() + 10))
+        bibfile = latexdiffcite.MappedBibFile(str(path), 'latin-1', None, index_dir)
+        assert bibfile.lookup('bar') == (['Bar'], '2011')
+        assert bibfile.n_scanned == 2
+
+        # a closed file is mapped again for a later lookup, without scanning it again
+        bibfile.close()
+        assert bibfile.map is None
+        assert bibfile.lookup('foo') == (['Föø'], '2010')
+        assert bibfile.n_scanned == 2
+
+        path.write('')
+        assert latexdiffcite.MappedBibFile(str(path), 'latin-1').lookup('foo') is None
 
     def test_initiate_from_args_bbl2(self):
         '''Tests that --bbl2 optional argument is handled correctly'''
         parsed_args = parser.parse_args(['file', 'foo', 'bar', '--bbl', '--bbl2', 'baz'])
 
-        latexdiffcite.initiate_from_args(parsed_args)
-        assert latexdiffcite.Files.bbl_old_path == 'foo.bbl'
-        assert latexdiffcite.Files.bbl_new_path == os.path.join('baz', 'bar.bbl')
+        job = latexdiffcite.initiate_from_args(parsed_args)
+        assert job.old.bbl_path == 'foo.bbl'
+        assert job.new.bbl_path == os.path.join('baz', 'bar.bbl')
+
+    def test_diff_cache(self, tmpdir, mocker):
+        '''Test that latexdiff is not run again for identical input, arguments and version'''
+        mocker.patch('latexdiffcite.latexdiffcite.get_latexdiff_version', return_value='latexdiff 1.2.1')
+        mocked_latexdiff = mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', side_effect=mock_run_latexdiff)
+        fname_old = os.path.join('tests', 'ascii_LF', 'test.tex')
+        fname_new = os.path.join('tests', 'utf-8_LF', 'test.tex')
+        args = ['file', '-s', fname_old, fname_new, '--cache-dir', str(tmpdir.join('cache'))]
+        for i in range(2):
+            latexdiffcite.main(args + ['-o', str(tmpdir.join('diff{}.tex'.format(i)))])
+        assert mocked_latexdiff.call_count == 1
+        assert tmpdir.join('diff0.tex').read() == tmpdir.join('diff1.tex').read()
+
+        # different latexdiff version
+        mocker.patch('latexdiffcite.latexdiffcite.get_latexdiff_version', return_value='latexdiff 1.3.0')
+        latexdiffcite.main(args + ['-o', str(tmpdir.join('diff2.tex'))])
+        assert mocked_latexdiff.call_count == 2
+        assert len(tmpdir.join('cache', 'diffs').listdir()) == 2
+
+        # the output of --chunked is cached separately
+        latexdiffcite.main(args + ['--chunked', '-o', str(tmpdir.join('diff3.tex'))])
+        assert len(tmpdir.join('cache', 'diffs').listdir()) == 3
+
+    def test_latexdiff_version_once(self, mocker):
+        '''Test that latexdiff --version is run once per process'''
+        popen = mocker.patch('subprocess.Popen')
+        popen.return_value.communicate.return_value = (b'latexdiff 1.3.0\n', b'')
+        popen.return_value.wait.return_value = 0
+        latexdiffcite.get_latexdiff_version.cache_clear()
+        try:
+            for i in range(2):
+                assert latexdiffcite.get_latexdiff_version() == 'latexdiff 1.3.0'
+        finally:
+            latexdiffcite.get_latexdiff_version.cache_clear()
+        assert popen.call_count == 1
+
+    def test_diff_cache_evict(self, tmpdir):
+        '''Test that outputs are evicted by age and by total size, least recently used first'''
+        cache = latexdiffcite.DiffCache(str(tmpdir), 1, 30)
+        cache.max_bytes = 25
+        out = tmpdir.join('diff.tex')
+        for i, key in enumerate(['a', 'b', 'c']):
+            out.write('x'*10)
+            cache.put(key, str(out))
+            os.utime(str(tmpdir.join('diffs', key + '.tex')), (1000 + i, time.time() - 100 + i))
+        # b was used last, so a and c are evicted when d is added
+        assert cache.get('b', str(out))
+        out.write('x'*10)
+        cache.put('d', str(out))
+        assert sorted(f.basename for f in tmpdir.join('diffs').listdir()) == ['b.tex', 'd.tex']
+        # all outputs older than max age are evicted
+        cache.max_age = 0
+        cache.evict()
+        assert tmpdir.join('diffs').listdir() == []
+
+    def test_identical_revisions(self, tmpdir, mocker):
+        '''Test that latexdiff is not run if the revisions are identical after processing'''
+        mocked_latexdiff = mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        fname = os.path.join('tests', 'ascii_LF', 'test.tex')
+        config = latexdiffcite.Config(os.path.join('tests', 'configs', 'config_numeric.json'))
+        job = latexdiffcite.DiffJob(fname, fname, str(tmpdir.join('diff.tex')), config)
+        latexdiffcite.run(job)
+        assert not mocked_latexdiff.called
+        assert tmpdir.join('diff.tex').read() == out_numeric.replace('{ACCENTED_CHARACTERS}', '')
+        config.no_change_marker = 'no changes\n'
+        latexdiffcite.run(latexdiffcite.DiffJob(fname, fname, str(tmpdir.join('diff.tex')), config))
+        assert tmpdir.join('diff.tex').read() == 'no changes\n'
+
+    def test_chunked(self, tmpdir, mocker):
+        '''Test that latexdiff is run on the preamble and each changed section, and the results are stitched'''
+        mocked_latexdiff = mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', side_effect=mock_run_latexdiff)
+        template = '\\documentclass{{article}}\n\\begin{{document}}\nIntro\n{}\\end{{document}}\n'
+        tmpdir.join('old.tex').write(template.format('\\section{A}\na\n\\section{B}\nb\n\\section{C}\nc\n'))
+        tmpdir.join('new.tex').write(template.format('\\section{A}\nA\n\\section{B}\nb\n\\section[D]{D}\nd\n'
+                                                     '% \\section{commented}\n\\section*{E}\ne\n'))
+        config = latexdiffcite.Config(os.path.join('tests', 'configs', 'config_numeric.json'))
+        job = latexdiffcite.DiffJob(str(tmpdir.join('old.tex')), str(tmpdir.join('new.tex')),
+                                    str(tmpdir.join('diff.tex')), config, chunked=True, max_workers=2)
+        latexdiffcite.run(job)
+        # preamble, section A, and sections C/D/E joined
+        assert mocked_latexdiff.call_count == 3
+        assert tmpdir.join('diff.tex').read() == job.new.tex
+
+    def test_align_sections(self):
+        old = [(None, '0'), ('A', 'a'), ('B', 'b'), ('C', 'c')]
+        new = [(None, '0'), ('A', 'a2'), ('X', 'x'), ('B', 'b'), ('D', 'd')]
+        assert latexdiffcite.align_sections(old, new) == [('0', '0'), ('a', 'a2'), ('', 'x'), ('b', 'b'), ('c', 'd')]
+
+    def test_fifo_transport(self, tmpdir, mocker):
+        '''Test feeding latexdiff through named pipes, also if it does not read all input'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', side_effect=mock_run_latexdiff)
+        config = latexdiffcite.Config(os.path.join('tests', 'configs', 'config_numeric.json'))
+        config.latexdiff_transport = 'fifo'
+        config.temp_dir = str(tmpdir.mkdir('ram'))
+        job = latexdiffcite.DiffJob(os.path.join('tests', 'ascii_LF', 'test.tex'),
+                                    os.path.join('tests', 'utf-8_LF', 'test.tex'), str(tmpdir.join('diff.tex')), config)
+        latexdiffcite.run(job)
+        assert tmpdir.join('diff.tex').read_text('utf-8') == job.new.tex
+        assert tmpdir.join('ram').listdir() == []
+
+    def test_cleanup_on_signal(self, tmpdir, mocker):
+        '''Test that temp files are removed when terminated while latexdiff is running'''
+        def mock_terminated(job, file1, file2, out_path=None):
+            assert os.path.dirname(file1) == str(tmpdir.join('ram'))
+            os.kill(os.getpid(), signal.SIGTERM)
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', side_effect=mock_terminated)
+        tmpdir.mkdir('ram')
+        tmpdir.join('config.json').write(json.dumps({'temp_dir': str(tmpdir.join('ram'))}))
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        with pytest.raises(SystemExit) as excinfo:
+            latexdiffcite.main(['file', '-s', os.path.join('tests', 'ascii_LF', 'test.tex'),
+                                os.path.join('tests', 'utf-8_LF', 'test.tex'), '-c', str(tmpdir.join('config.json')),
+                                '-o', str(tmpdir.join('diff.tex'))])
+        assert excinfo.value.code == 128 + signal.SIGTERM
+        assert tmpdir.join('ram').listdir() == []
+        assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+    def test_cleanup_on_signal_chunked(self, tmpdir, monkeypatch):
+        '''Test that pending chunks are cancelled and running latexdiff processes are killed when terminated while
+        running latexdiff on each changed section'''
+        bindir = tmpdir.mkdir('bin')
+        bindir.join('latexdiff').write('#!{}\nimport sys, time\nopen({!r}, "a").write("run\\n")\ntime.sleep(1)\n'
+                                       'sys.stdout.write(open(sys.argv[2]).read())\n'.format(sys.executable,
+                                                                                         str(tmpdir.join('runs.log'))))
+        bindir.join('latexdiff').chmod(0o755)
+        monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+        template = '\\documentclass{{article}}\n\\begin{{document}}\n{}\\end{{document}}\n'
+        for name in ['old', 'new']:
+            tmpdir.join(name + '.tex').write(template.format(''.join('\\section{{{0}}}\n{0} {1}\n'.format(i, name)
+                                                                     for i in range(6))))
+        tmpdir.mkdir('ram')
+        tmpdir.join('config.json').write(json.dumps({'temp_dir': str(tmpdir.join('ram')), 'cmd_format': {}}))
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        start = time.time()
+        with pytest.raises(SystemExit):
+            latexdiffcite.main(['file', '-s', str(tmpdir.join('old.tex')), str(tmpdir.join('new.tex')), '--chunked',
+                                '-j', '1', '-c', str(tmpdir.join('config.json')), '-o', str(tmpdir.join('diff.tex'))])
+        assert time.time() - start < 1
+        assert tmpdir.join('runs.log').read() == 'run\n'
+        assert tmpdir.join('ram').listdir() == []
+
+    def test_preprocess_only(self, tmpdir, mocker, capsysbinary):
+        '''Test writing the processed revisions to files and stdout without running latexdiff'''
+        mocked_latexdiff = mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        fname = os.path.join('tests', 'ascii_LF', 'test.tex')
+        args = ['file', '-s', fname, fname, '-c', 'tests/configs/config_numeric.json', '-o', str(tmpdir.join('diff.tex'))]
+        latexdiffcite.main(args + ['--preprocess-only', str(tmpdir.join('old.tex')), '-'])
+        out_true = out_numeric.replace('{ACCENTED_CHARACTERS}', '')
+        assert tmpdir.join('old.tex').read() == out_true
+        assert capsysbinary.readouterr().out.decode('utf-8') == out_true
+        assert not tmpdir.join('diff.tex').check()
+        assert not mocked_latexdiff.called
+
+    def test_stats(self, tmpdir, mocker):
+        '''Test the timings and counters written with --stats'''
+        mocker.patch('latexdiffcite.latexdiffcite.subprocess.Popen', new=mock_popen)
+        fname_old = os.path.join('tests', 'ascii_LF', 'test.tex')
+        fname_new = os.path.join('tests', 'utf-8_LF', 'test.tex')
+        latexdiffcite.main(['file', '-s', fname_old, fname_new, '-c', 'tests/configs/config_authyear_bib.json',
+                            '-o', str(tmpdir.join('diff.tex')), '--stats', str(tmpdir.join('stats.json'))])
+        stats = json.loads(tmpdir.join('stats.json').read())
+        assert sorted(stats['timings']) == ['diff', 'latexdiff', 'process', 'write_temp']
+        assert stats['counters']['latexdiff_runs'] == 1
+        assert stats['counters']['bytes_written'] > 0
+        old = stats['revisions']['old']
+        assert old['path'] == fname_old
+        assert sorted(old['timings']) == ['bib', 'citations', 'read', 'replace']
+        assert old['counters']['bytes_read'] == sum(os.path.getsize(f) for f in
+                                                    [fname_old] + glob.glob('tests/ascii_LF/*.bib'))
+        assert old['counters']['citations'] > old['counters']['unique_keys'] > 0
+        assert old['counters']['bib_entries_scanned'] > old['counters']['bib_entries_parsed'] > 0
+
+    def test_parallel(self, tmpdir, mocker):
+        '''Tests that revisions processed in worker processes give the same result'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
+        fname = os.path.join('tests', 'ascii_LF', 'test.tex')
+        out_old, out_new = read_tempfiles(run_job(['file', fname, fname, '-s', '--parallel', '-c',
+                                                   'tests/configs/config_authyear_bib.json',
+                                                   '-o', str(tmpdir.join('diff.tex'))]))
+        out_true = out_author_year_agu_bib.replace('{ACCENTED_CHARACTERS}', '')
+        assert out_old == out_true
+        assert out_new == out_true
+
+    def test_main_repeated_no_handler_leak(self, tmpdir, mocker):
+        '''Tests that repeated calls to main() do not leave logging handlers behind, and restore the level of the
+        logger'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        mocker.patch.object(latexdiffcite.log, 'level', logging.WARNING)
+        fname = os.path.join('tests', 'ascii_LF', 'test.tex')
+        n_handlers = len(latexdiffcite.log.handlers)
+        for _ in range(3):
+            latexdiffcite.main(['file', fname, fname, '-s', '-o', str(tmpdir.join('diff.tex'))])
+        assert len(latexdiffcite.log.handlers) == n_handlers
+        assert latexdiffcite.log.level == logging.WARNING
+
+    def test_concurrent_jobs(self, tmpdir, mocker):
+        '''Tests that jobs with different settings can run concurrently in the same process'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
+        fname = os.path.join('tests', 'ascii_LF', 'test.tex')
+        configs = {'authyear': os.path.join('tests', 'configs', 'config_authyear_bib.json'),
+                   'numeric': os.path.join('tests', 'configs', 'config_numeric.json')}
+        jobs = dict((name, latexdiffcite.DiffJob(fname, fname, str(tmpdir.join(name + '.tex')),
+                                                 config=latexdiffcite.Config(cfg)))
+                    for name, cfg in configs.items())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(latexdiffcite.run, jobs.values()))
+        assert read_tempfiles(jobs['authyear'])[1] == out_author_year_agu_bib.replace('{ACCENTED_CHARACTERS}', '')
+        assert read_tempfiles(jobs['numeric'])[1] == out_numeric.replace('{ACCENTED_CHARACTERS}', '')
 
     def test_main(self, tmpdir, mocker):
         '''Tests the whole shebang, except actually calling latexdiff'''
@@ -452,6 +1019,213 @@ class TestIndividualFunctions():
         latexdiffcite.main(['file', fname, fname, '-v', '-l', str(tmpdir.join('log.log')),
                             '-o', str(tmpdir.join('diff.tex'))])
 
+    def test_git_bibfiles(self, tmpdir, mocker, monkeypatch):
+        '''Tests that bib files are read from the git revision, and parsed once if unchanged between revisions'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
+        spy = mocker.patch('latexdiffcite.latexdiffcite.index_bib_entries', wraps=latexdiffcite.index_bib_entries)
+        monkeypatch.chdir(tmpdir)
+        git_commit(tmpdir, {'doc/test.tex': '\\citet{foo}\n\\bibliography{refs}\n',
+                            'doc/refs.bib': '@article{foo,\n  author = {Foo, A.},\n  year = {2010}\n}\n'})
+        # uncommitted change in the working tree must not be used
+        tmpdir.join('doc', 'refs.bib').write('@article{foo,\n  author = {Bar, A.},\n  year = {2011}\n}\n')
+        job = latexdiffcite.DiffJob('doc/test.tex', 'doc/test.tex', git_revs=['HEAD', 'HEAD'])
+        latexdiffcite.run(job)
+        out_old, out_new = read_tempfiles(job)
+        assert '\\textit{Foo} [\\ldiffentity{2010}]' in out_old
+        assert out_new == out_old
+        assert job.old.bib_oids == job.new.bib_oids
+        assert spy.call_count == 1
+
+    def test_git_bibfile_in_parent_dir(self, tmpdir, mocker, monkeypatch):
+        '''Tests reading a bib file in a parent directory of the tex file from git'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
+        mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
+        monkeypatch.chdir(tmpdir)
+        git_commit(tmpdir, {'doc/test.tex': '\\citet{foo}\n\\bibliography{../refs}\n',
+                            'refs.bib': '@article{foo,\n  author = {Foo, A.},\n  year = {2010}\n}\n'})
+        job = latexdiffcite.DiffJob('doc/test.tex', 'doc/test.tex', git_revs=['HEAD', 'HEAD'])
+        latexdiffcite.run(job)
+        out_old, out_new = read_tempfiles(job)
+        assert '\\textit{Foo} [\\ldiffentity{2010}]' in out_old
+        assert job.old.bib_paths == ['refs.bib']
+
+    def test_git_range(self, tmpdir, mocker, monkeypatch):
+        '''Tests diffing each commit in a range, processing identical revisions once'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', new=mock_run_latexdiff)
+        spy = mocker.patch('latexdiffcite.latexdiffcite.process_revision', wraps=latexdiffcite.process_revision)
+        monkeypatch.chdir(tmpdir)
+        bib = '@article{foo,\n  author = {Foo, A.},\n  year = {2010}\n}\n'
+        git_commit(tmpdir, {'test.tex': 'first \\citet{foo}\n\\bibliography{refs}\n', 'refs.bib': bib})
+        git_commit(tmpdir, {'test.tex': 'second \\citet{foo}\n\\bibliography{refs}\n'})
+        git_commit(tmpdir, {'test.tex': 'third \\citet{foo}\n\\bibliography{refs}\n'})
+        git_commit(tmpdir, {'README': 'not part of the document'})
+        tmpdir.join('out').ensure(dir=True)
+        latexdiffcite.main(['git', '-s', 'test.tex', 'HEAD~3..HEAD', '-R', '-j', '2', '-o', 'out/diff.tex',
+                            '--stats', 'stats.json'])
+        outputs = sorted(tmpdir.join('out').listdir())
+        assert len(outputs) == 3
+        stats = json.loads(tmpdir.join('stats.json').read())
+        assert sorted(s['output'] for s in stats) == sorted(os.path.join('out', f.basename) for f in outputs)
+        assert [s['counters'].get('identical', 0) for s in stats] == [0, 0, 1]
+        # each commit is reported with its own revision, and the stats of processing only for the processed commits
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+        last = [s for s in stats if s['counters'].get('identical')][0]['revisions']
+        assert last['new']['git_rev'] == head and last['old']['git_rev'] != head
+        assert 'citations' in last['old']['counters'] and 'citations' not in last['new']['counters']
+        contents = [f.read() for f in outputs]
+        assert sorted(c.split()[0] for c in contents) == ['second', 'third', 'third']
+        # four commits, but the last two are identical
+        assert spy.call_count == 3
+
+        chunked = mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff_chunked',
+                               wraps=latexdiffcite.run_latexdiff_chunked)
+        latexdiffcite.main(['git', '-s', 'test.tex', 'HEAD~3..HEAD', '-R', '--chunked', '-o', 'out/diff.tex'])
+        assert chunked.call_count == 2
+
+        with pytest.raises(SystemExit):
+            latexdiffcite.main(['git', '-s', 'test.tex', 'HEAD~3..HEAD', 'HEAD', '-R'])
+        for option in ['-P', '--bbl2']:
+            with pytest.raises(SystemExit):
+                latexdiffcite.main(['git', '-s', 'test.tex', 'HEAD~3..HEAD', '-R', option])
+
+    def test_flatten(self, tmpdir, mocker):
+        '''Tests that included files are expanded recursively, and read once if included by both revisions'''
+        spy = mocker.patch('latexdiffcite.latexdiffcite.read_file', wraps=latexdiffcite.read_file)
+        files = {'main.tex': '\\begin{document}\n\\input{chapters/intro}\n\\include{chapters/methods.tex}\n'
+                             '\\subfile{sub}\n% \\input{commented}\n\\input{missing}\n\\end{document}\n',
+                 'chapters/intro.tex': 'Intro \\citep{foo}.\n\\input{chapters/detail}\n',
+                 'chapters/detail.tex': 'Detail \\citet{bar}.\n',
+                 'chapters/methods.tex': 'Methods.\n',
+                 'sub.tex': '\\documentclass[main]{subfiles}\n\\begin{document}\nSub \\citep{baz}.\n\\end{document}\n'}
+        for fname, contents in files.items():
+            tmpdir.join(fname).write(contents, ensure=True)
+        job = latexdiffcite.DiffJob(str(tmpdir.join('main.tex')), str(tmpdir.join('main.tex')))
+        job.config.flatten = True
+        job.config.cmd_format = {}
+        latexdiffcite.read_revisions(job)
+        assert job.old.tex == ('\\begin{document}\nIntro \\citep{foo}.\nDetail \\citet{bar}.\n'
+                               '\\clearpage\nMethods.\n\\clearpage\n\nSub \\citep{baz}.\n'
+                               '% \\input{commented}\n\\input{missing}\n\\end{document}\n')
+        assert job.new.tex == job.old.tex
+        assert job.old.stats.counters['included_files'] == 4
+        # main.tex twice, the four included files once
+        assert spy.call_count == 6
+
+        tmpdir.join('chapters', 'detail.tex').write('\\input{chapters/intro}\n')
+        job = latexdiffcite.DiffJob(str(tmpdir.join('main.tex')), str(tmpdir.join('main.tex')))
+        job.config.flatten = True
+        with pytest.raises(ValueError):
+            latexdiffcite.read_revisions(job)
+
+    def test_git_flatten(self, tmpdir, mocker, monkeypatch):
+        '''Tests flattening in git mode, with included files read from the revisions in one request'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', new=mock_run_latexdiff)
+        spy = mocker.spy(latexdiffcite.GitCatFile, 'read_many')
+        monkeypatch.chdir(tmpdir)
+        bib = '@article{foo,\n  author = {Foo, A.},\n  year = {2010}\n}\n'
+        git_commit(tmpdir, {'doc/test.tex': '\\input{a}\n\\input{b}\n\\bibliography{refs}\n', 'doc/refs.bib': bib,
+                            'doc/a.tex': 'first \\citet{foo}\n', 'doc/b.tex': 'unchanged\n'})
+        git_commit(tmpdir, {'doc/a.tex': 'second \\citet{foo}\n'})
+        latexdiffcite.main(['git', '-s', 'doc/test.tex', 'HEAD~1', 'HEAD', '--flatten', '-o', 'diff.tex'])
+        assert tmpdir.join('diff.tex').read().startswith('second \\ldiffentity{\\textit{Foo} [\\ldiffentity{2010}]}\nunchanged\n')
+        # tex, a.tex and b.tex, bib file for each revision
+        assert [len(call[0][1]) for call in spy.call_args_list] == [1, 2, 1, 1, 2, 1]
+
+        # the git process is still usable after missing files
+        git = latexdiffcite.GitCatFile()
+        try:
+            results = git.read_many(['doc/a.tex', 'doc/missing.tex', 'doc/b.tex'], 'HEAD', missing_ok=True)
+            assert [contents for _, contents in results] == [b'second \\citet{foo}\n', None, b'unchanged\n']
+            with pytest.raises(ValueError):
+                git.read_many(['doc/missing.tex', 'doc/a.tex'], 'HEAD')
+            assert git.read('doc/b.tex', 'HEAD~1')[1] == b'unchanged\n'
+        finally:
+            git.close()
+
+    def test_batch(self, tmpdir, mocker):
+        '''Tests batch mode in a single process, with a failing job and a report'''
+        mocker.patch('latexdiffcite.latexdiffcite.subprocess.Popen', new=mock_popen)
+        spy = mocker.patch('latexdiffcite.latexdiffcite.index_bib_entries', wraps=latexdiffcite.index_bib_entries)
+        fname = os.path.join('tests', 'utf-8_LF', 'test.tex')
+        manifest = [{'old': fname, 'new': fname, 'output': str(tmpdir.join('diff1.tex'))},
+                    {'old': fname, 'new': 'nonexistent.tex', 'output': str(tmpdir.join('diff2.tex'))},
+                    {'old': fname, 'new': fname, 'output': str(tmpdir.join('diff3.tex'))}]
+        tmpdir.join('manifest.json').write(json.dumps(manifest))
+        ret = latexdiffcite.main(['batch', str(tmpdir.join('manifest.json')), '-j', '1', '--no-cache',
+                                  '-r', str(tmpdir.join('report.json'))])
+        assert ret == 1
+        report = json.loads(tmpdir.join('report.json').read())
+        assert [r['status'] for r in report] == ['ok', 'failed', 'ok']
+        assert [r['exit_code'] for r in report] == [0, 1, 0]
+        assert report[0]['error'] is None and report[1]['error']
+        assert tmpdir.join('diff1.tex').check() and tmpdir.join('diff3.tex').check()
+        # the two bib files are shared by all jobs and only indexed once each
+        assert spy.call_count == 2
+
+    def test_batch_parallel_cache(self, tmpdir, mocker):
+        '''Tests batch mode with two worker processes sharing the bib cache, where latexdiff of one job runs while the
+        other job uses the cache (the cache must not stay locked by a job until it is done)'''
+        real_connect = latexdiffcite.sqlite3.connect
+
+        def mock_connect(path, timeout=5.0):
+            return real_connect(path, timeout=0.2)
+
+        def slow_run_latexdiff(job, file1, file2, out_path=None):
+            time.sleep(1)
+            mock_run_latexdiff(job, file1, file2, out_path)
+
+        mocker.patch('latexdiffcite.latexdiffcite.sqlite3.connect', new=mock_connect)
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', new=slow_run_latexdiff)
+        manifest = []
+        for i, folder in enumerate(['utf-8_LF', 'ascii_LF']):
+            fname = os.path.join('tests', folder, 'test.tex')
+            for bib in ['bibl1.bib', 'bibl2.bib']:
+                shutil.copy(os.path.join('tests', folder, bib), str(tmpdir.join(folder, bib).ensure()))
+            tmpdir.join(folder, 'test.tex').write(read_file(fname).replace('\\end{document}', 'Added.\n\\end{document}'))
+            manifest.append({'old': fname, 'new': str(tmpdir.join(folder, 'test.tex')),
+                             'output': str(tmpdir.join('diff{}.tex'.format(i)))})
+        tmpdir.join('manifest.json').write(json.dumps(manifest))
+        ret = latexdiffcite.main(['batch', str(tmpdir.join('manifest.json')), '-j', '2', '-s',
+                                  '--cache-dir', str(tmpdir.join('cache')), '-r', str(tmpdir.join('report.json'))])
+        report = json.loads(tmpdir.join('report.json').read())
+        assert [r['error'] for r in report] == [None, None]
+        assert ret == 0
+        cache = latexdiffcite.BibCache(str(tmpdir.join('cache')), 1000)
+        assert cache.db.execute('SELECT COUNT(*) FROM files').fetchone()[0] > 0
+        cache.close()
+
+    @pytest.mark.parametrize('n_workers', ['1', '2'])
+    def test_batch_cache_error(self, tmpdir, mocker, n_workers):
+        '''Tests that a bib cache that cannot be opened fails the jobs, not the batch'''
+        mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff', new=mock_run_latexdiff)
+        fname = os.path.join('tests', 'utf-8_LF', 'test.tex')
+        manifest = [{'old': fname, 'new': fname, 'output': str(tmpdir.join('diff{}.tex'.format(i)))} for i in range(2)]
+        tmpdir.join('manifest.json').write(json.dumps(manifest))
+        tmpdir.join('notadir').write('')
+        ret = latexdiffcite.main(['batch', str(tmpdir.join('manifest.json')), '-j', n_workers, '-s',
+                                  '--cache-dir', str(tmpdir.join('notadir')), '-r', str(tmpdir.join('report.json'))])
+        assert ret == 1
+        report = json.loads(tmpdir.join('report.json').read())
+        assert [r['status'] for r in report] == ['failed', 'failed']
+        assert latexdiffcite.batch_worker is None
+
+    def test_init_batch_worker(self):
+        '''Tests that batch worker processes do not use the signal handlers of the main process'''
+        previous = latexdiffcite.setup_signals()
+        try:
+            latexdiffcite.init_batch_worker(latexdiffcite.Config())
+            assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+            assert latexdiffcite.batch_worker.bib_files == {}
+        finally:
+            latexdiffcite.batch_worker = None
+            latexdiffcite.remove_signals(previous)
+
+    def test_batch_invalid_manifest(self, tmpdir):
+        tmpdir.join('manifest.json').write(json.dumps([{'old': 'test.tex'}]))
+        with pytest.raises(ValueError):
+            latexdiffcite.main(['batch', str(tmpdir.join('manifest.json'))])
+
 # ==============================================================================
 #  Subprocess calls: Test invocations
 # ==============================================================================
@@ -480,34 +1254,18 @@ def test_run_script():
 #-------------------------------------------------------------------------------
 
 
-@pytest.fixture
-def reset(request):
-    reset_everything()
-
-    def destroy_tempfiles():
-        real_destroy_tempfiles()
-
-    request.addfinalizer(destroy_tempfiles)
-
-
-def test_home_conf(tmpdir, mocker, reset):
+def test_home_conf(tmpdir, mocker):
     '''Tests loading of configuration file in user's home directory'''
     def mock_expanduser(path):
         '''Make expanduser expand to temporary directory instead of home directory'''
         return path.replace('~', str(tmpdir))
     mocker.patch('latexdiffcite.latexdiffcite.os.path.expanduser', side_effect=mock_expanduser)
-    mocker.patch('latexdiffcite.latexdiffcite.Files.destroy_tempfiles')
+    mocker.patch('latexdiffcite.latexdiffcite.DiffJob.destroy_tempfiles')
     mocker.patch('latexdiffcite.latexdiffcite.run_latexdiff')
     shutil.copy(os.path.join('tests', 'configs', 'config_numeric.json'), os.path.join(str(tmpdir), '.latexdiffcite.json'))
     fname = os.path.join('tests', 'ascii_LF', 'test.tex')
-    args = ['file', fname, fname]
-    parsed_args = parser.parse_args(args)
-    latexdiffcite.initiate_from_args(parsed_args)
-    latexdiffcite.run(parsed_args)
-    latexdiffcite.Files.tex_old_tmp_hndl.seek(0)
-    latexdiffcite.Files.tex_new_tmp_hndl.seek(0)
-    out_old = latexdiffcite.Files.tex_old_tmp_hndl.read().decode('utf-8')
-    out_new = latexdiffcite.Files.tex_new_tmp_hndl.read().decode('utf-8')
+    args = ['file', fname, fname, '-o', str(tmpdir.join('diff.tex'))]
+    out_old, out_new = read_tempfiles(run_job(args))
     out_true = out_numeric.replace('{ACCENTED_CHARACTERS}', '')
     assert out_old == out_true
     assert out_new == out_true